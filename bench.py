@@ -0,0 +1,841 @@
+"""
+Local load tools for the bot, no Telegram involved.
+
+    python bench.py fake-api --port 8081
+        Fake Bot API server that answers every method. Start the bot with
+        TELEGRAM_API=http://127.0.0.1:8081 so its outgoing calls land here.
+
+    python bench.py webhook --url http://127.0.0.1:8080/webhook --users 200
+        POSTs synthetic Update JSON to a bot running with BOT_MODE=webhook
+        and reports updates/sec and latency percentiles.
+
+    python bench.py load --users 5000 --concurrency 500
+        Drives the Dispatcher in-process with the scripted flows (activity,
+        sync, idea, list) for thousands of virtual users, Bot API stubbed
+        out. Reports updates/sec, per-handler latency percentiles, storage
+        I/O and Bot API call counts.
+
+    python bench.py latency --users 200 --disk-delay 5
+        Runs the scripted flows for N concurrent in-process users and
+        reports per-update latency. --disk-delay adds a sleep (ms) to every
+        storage call to show what a slow disk does to everyone else.
+
+    python bench.py checkins --years 10
+        Writes a daily sync check-in for N years into a throwaway history
+        file and times the trend queries on it.
+
+    python bench.py shards --workers 1 4 --users 400
+        Starts the fake Bot API and bot.py with BOT_MODE=sharded on a
+        throwaway data dir, once per worker count, and runs the webhook
+        load against each. Throughput only scales with free cores.
+
+    python bench.py api-calls
+        Runs each scripted flow once for a fresh user and prints the Bot
+        API calls it costs, by method.
+
+    python bench.py client --chats 20 --messages 6 --drop 0.02
+        Sends to many chats at once against a fake Bot API that enforces
+        per-chat and global limits (429 with retry_after) and cuts some
+        connections, through a plain Bot and through PacedBot, and reports
+        what got delivered, in what order and how many 429s it took.
+
+    python bench.py bigbang --users 20000
+        Fills a throwaway data dir with N users and resets it with the
+        admin's bigbang: times the reset, the longest event loop stall
+        during it and the snapshot's deletion in the background.
+
+    python bench.py crash --rounds 20
+        Kills a process flushing activity changes to the SQLite store
+        (SIGKILL at a random moment) and checks that every user reloads
+        with whole flushes only.
+
+    python bench.py race --rounds 50 --taps 5
+        Loads the bot in-process on a throwaway data dir and fires
+        concurrent duplicate callbacks for one user, checking that no task
+        is lost or duplicated.
+"""
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+
+from aiohttp import ClientSession, web
+
+from checkins import CheckinLog
+
+FAKE_TOKEN = "123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+
+
+# ================= SYNTHETIC UPDATES =================
+_ids = itertools.count(1)
+# chat id -> the bot's latest message there, which is what a button tap
+# in that chat comes attached to. Only api-calls turns this on: parsing
+# the keyboards back costs the load runs about a quarter of their throughput.
+last_messages = {}
+track_messages = False
+
+FLOWS = {
+    "activity": [
+        ("msg", "/start"), ("msg", "🐱"), ("cb", "main"), ("cb", "get"),
+        ("cb", "keep"), ("cb", "done"), ("cb", "discard"), ("cb", "keep"),
+        ("cb", "change"), ("cb", "keep"),
+    ],
+    "sync": [
+        ("msg", "/start"), ("msg", "🦁"), ("cb", "sync"),
+        ("cb", "energy_calm"), ("cb", "weather_clear"), ("cb", "social_one"),
+        ("cb", "focus_body"), ("cb", "time_2h"), ("cb", "desire_create"),
+        ("cb", "intensity_mid"), ("cb", "word_interest"),
+    ],
+    "idea": [
+        ("msg", "/start"), ("msg", "🐱"), ("cb", "main"), ("cb", "submit"),
+        ("msg", "Устроить пикник на крыше"), ("cb", "yes"), ("cb", "done"),
+    ],
+    "list": [
+        ("msg", "/start"), ("msg", "🐱"), ("cb", "main"), ("cb", "list"),
+        ("cb", "choose"), ("msg", "2"), ("cb", "change"), ("cb", "discard"),
+    ],
+}
+
+
+# api-calls also runs a returning user and a delete with a double tap
+API_FLOWS = dict(
+    FLOWS,
+    returning=[
+        ("msg", "/start"), ("msg", "🐱"), ("cb", "main"), ("cb", "get"),
+        ("cb", "keep"), ("msg", "/start"), ("cb", "done"),
+    ],
+    delete=[
+        ("msg", "/start"), ("msg", "🐱"), ("cb", "main"), ("cb", "list"),
+        ("cb", "delete"), ("msg", "1 2"), ("cb", "list"), ("cb", "back_to_action"),
+        ("cb", "back_to_action"),
+    ],
+)
+
+
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+
+
+def _chat(uid):
+    return {"id": uid, "type": "private"}
+
+
+def message_update(uid, text):
+    msg = {
+        "message_id": next(_ids),
+        "date": int(time.time()),
+        "chat": _chat(uid),
+        "from": _user(uid),
+        "text": text,
+    }
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": next(_ids), "message": msg}
+
+
+def callback_update(uid, data):
+    message = track_messages and last_messages.get(uid) or {
+        "message_id": next(_ids),
+        "date": int(time.time()),
+        "chat": _chat(uid),
+        "text": "...",
+    }
+    return {
+        "update_id": next(_ids),
+        "callback_query": {
+            "id": str(next(_ids)),
+            "from": _user(uid),
+            "chat_instance": str(uid),
+            "data": data,
+            "message": dict(message),
+        },
+    }
+
+
+def bot_message(method, data):
+    """The Message a send/edit call results in; remembered for callbacks."""
+    chat_id = int(data.get("chat_id") or 0)
+    if not track_messages:
+        return {
+            "message_id": next(_ids),
+            "date": int(time.time()),
+            "chat": _chat(chat_id),
+            "text": data.get("text", ""),
+        }
+    message = last_messages.get(chat_id) if method.startswith("edit") else None
+    if message is None:
+        message = {"message_id": next(_ids), "date": int(time.time()), "chat": _chat(chat_id)}
+    if "text" in data:
+        message["text"] = data["text"]
+    markup = data.get("reply_markup")
+    if markup:
+        message["reply_markup"] = json.loads(markup) if isinstance(markup, str) else markup
+    else:
+        message.pop("reply_markup", None)
+    last_messages[chat_id] = message
+    return dict(message)
+
+
+def flow_updates(uid, flow):
+    for kind, payload in API_FLOWS[flow]:
+        if kind == "msg":
+            yield message_update(uid, payload)
+        else:
+            yield callback_update(uid, payload)
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    if not samples:
+        return {p: 0.0 for p in points}
+    ordered = sorted(samples)
+    return {p: ordered[min(len(ordered) - 1, len(ordered) * p // 100)] for p in points}
+
+
+# ================= FAKE BOT API =================
+def make_fake_api(chat_limit=0, global_limit=0, drop=0.0, chat_burst=3):
+    """
+    aiohttp app answering Bot API calls the way Telegram would. With
+    chat_limit / global_limit (messages per second, bursts of chat_burst
+    and global_limit) it answers sends and edits over the limit with 429
+    and a retry_after; with `drop` it cuts that share of connections
+    before answering.
+    """
+    calls = Counter()
+    sent = defaultdict(list)
+    buckets = {}
+
+    def flooded(key, rate, burst, now):
+        # token bucket; retry_after is whole seconds, like Telegram's
+        tokens, stamp = buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - stamp) * rate)
+        if tokens < 1:
+            buckets[key] = (tokens, now)
+            return max(1, int((1 - tokens) / rate + 0.999))
+        buckets[key] = (tokens - 1, now)
+        return 0
+
+    async def handle(request):
+        method = request.match_info["method"]
+        form = await request.post()
+        if drop and random.random() < drop:
+            calls["(dropped)"] += 1
+            request.transport.close()
+            return web.Response()
+        calls[method] += 1
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            result = []
+        elif method.startswith("send") or method.startswith("edit"):
+            now = time.monotonic()
+            wait = (chat_limit and flooded(form.get("chat_id"), chat_limit, chat_burst, now)
+                    or global_limit and flooded(None, global_limit, global_limit, now))
+            if wait:
+                calls["(429)"] += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {wait}",
+                    "parameters": {"retry_after": wait},
+                }, status=429)
+            sent[form.get("chat_id")].append(form.get("text"))
+            result = bot_message(method, dict(form))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def stats(request):
+        return web.json_response(dict(calls))
+
+    app = web.Application()
+    app["calls"] = calls
+    app["sent"] = sent
+    app.router.add_post("/bot{token}/{method}", handle)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+# ================= OFFLINE BOT =================
+def load_bot(data_dir):
+    """
+    Import bot.py against `data_dir` with every Bot API call answered
+    locally. Returns the module and a Counter of API calls by method.
+    """
+    os.environ["DVOIKA_DATA"] = data_dir
+    try:
+        from bot_token import BOT_TOKEN  # noqa: F401
+    except ImportError:
+        sys.modules["bot_token"] = SimpleNamespace(BOT_TOKEN=FAKE_TOKEN)
+    import bot
+    from aiogram import Bot
+
+    calls = Counter()
+
+    async def request(method, data=None, files=None, **kwargs):
+        calls[method] += 1
+        if method.startswith("send") or method.startswith("edit"):
+            return bot_message(method, data or {})
+        return True
+
+    bot.bot.request = request
+    # Admin digests wait for the real API's sake; nothing to wait for here.
+    bot.notifier.window = 0
+    Bot.set_current(bot.bot)
+    bot.Dispatcher.set_current(bot.dp)
+    return bot, calls
+
+
+async def feed(bot, update):
+    # Each update gets its own task, as under polling: aiogram caches the
+    # FSM state in a context variable per update.
+    from aiogram import types
+    await asyncio.create_task(bot.dp.process_update(types.Update(**update)))
+
+
+async def shutdown(bot):
+    await bot.on_shutdown(bot.dp)
+    await bot.dp.storage.close()
+    await bot.dp.storage.wait_closed()
+
+
+def instrument_storage(bot, counts=None, delay_ms=0):
+    """
+    Wrap every call that reaches the disk: activity backend and FSM
+    storage. Calls are tallied into `counts` and each one sleeps
+    `delay_ms`, as on a busy disk.
+    """
+    def wrapped(label, fn):
+        def wrapper(*args, **kwargs):
+            if counts is not None:
+                counts[label] += 1
+            if delay_ms:
+                time.sleep(delay_ms / 1000)
+            return fn(*args, **kwargs)
+        return wrapper
+
+    backend = bot.activity.backend
+    for name in ("load", "save", "load_root", "add_root", "reset"):
+        setattr(backend, name, wrapped(f"activity.{name}", getattr(backend, name)))
+    storage = bot.dp.storage
+    for name in ("_fetch", "_commit"):
+        if hasattr(storage, name):
+            setattr(storage, name, wrapped(f"fsm.{name.lstrip('_')}", getattr(storage, name)))
+
+
+def time_handlers(bot):
+    """Time every registered handler. Returns {handler name: [seconds]}."""
+    timings = defaultdict(list)
+
+    def timed(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                timings[fn.__name__].append(time.perf_counter() - started)
+        return wrapper
+
+    for observer in (bot.dp.message_handlers, bot.dp.callback_query_handlers):
+        for handler_obj in observer.handlers:
+            handler_obj.handler = timed(handler_obj.handler)
+    return timings
+
+
+# ================= LATENCY =================
+async def run_latency(users, disk_delay, uid_base=1000):
+    with tempfile.TemporaryDirectory() as data_dir:
+        bot, _ = load_bot(data_dir)
+        if disk_delay:
+            instrument_storage(bot, delay_ms=disk_delay)
+        await bot.on_startup(bot.dp)
+
+        latencies = []
+        flows = list(FLOWS)
+
+        async def virtual_user(i):
+            for update in flow_updates(uid_base + i, flows[i % len(flows)]):
+                started = time.perf_counter()
+                await feed(bot, update)
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(virtual_user(i) for i in range(users)))
+        elapsed = time.perf_counter() - started
+
+        p = percentiles(latencies)
+        print(f"{len(latencies)} updates from {users} users in {elapsed:.2f}s "
+              f"(disk delay {disk_delay}ms)")
+        print(f"latency p50={p[50] * 1000:.1f}ms p95={p[95] * 1000:.1f}ms p99={p[99] * 1000:.1f}ms")
+        await shutdown(bot)
+
+
+# ================= LOAD =================
+async def run_load(users, concurrency, disk_delay, uid_base=100000):
+    with tempfile.TemporaryDirectory() as data_dir:
+        bot, calls = load_bot(data_dir)
+        io = Counter()
+        instrument_storage(bot, io, disk_delay)
+        timings = time_handlers(bot)
+        await bot.on_startup(bot.dp)
+
+        sem = asyncio.Semaphore(concurrency)
+        flows = list(FLOWS)
+        per_flow = Counter()
+
+        async def virtual_user(i):
+            flow = flows[i % len(flows)]
+            async with sem:
+                for update in flow_updates(uid_base + i, flow):
+                    await feed(bot, update)
+                    per_flow[flow] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(virtual_user(i) for i in range(users)))
+        elapsed = time.perf_counter() - started
+        await bot.activity.flush()
+        await bot.dp.storage.flush()
+
+        total = sum(per_flow.values())
+        print(f"{total} updates from {users} users in {elapsed:.2f}s "
+              f"= {total / elapsed:.1f} updates/sec")
+        print("flows: " + ", ".join(f"{flow}={n}" for flow, n in sorted(per_flow.items())))
+
+        print(f"\n{'handler':<20}{'calls':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for name, samples in sorted(timings.items(), key=lambda kv: -len(kv[1])):
+            p = percentiles(samples)
+            print(f"{name:<20}{len(samples):>8}{p[50] * 1000:>10.2f}"
+                  f"{p[95] * 1000:>10.2f}{p[99] * 1000:>10.2f}")
+
+        print(f"\nstorage I/O: {sum(io.values())} calls, {sum(io.values()) / total:.2f} per update")
+        for label, n in sorted(io.items()):
+            print(f"  {label:<18}{n:>8}")
+        print(f"Bot API: {sum(calls.values())} calls "
+              f"({', '.join(f'{m}={n}' for m, n in calls.most_common())})")
+        await shutdown(bot)
+
+
+# ================= CHECKINS =================
+def run_checkins(years):
+    fields = [(f"q{i}", [f"q{i}_{a}" for a in range(5)]) for i in range(8)]
+    with tempfile.TemporaryDirectory() as directory:
+        log = CheckinLog(directory, fields)
+        now = time.time()
+        days = years * 365
+        for day in range(days):
+            answers = {name: random.choice(options) for name, options in fields}
+            log.append(1, answers, when=now - (days - day) * 86400)
+        print(f"{days} check-ins: {os.path.getsize(log.path(1)) / 1024:.1f} KB")
+
+        for window in (7, 30, 365, None):
+            started = time.perf_counter()
+            log.distribution(1, days=window)
+            elapsed = time.perf_counter() - started
+            label = f"last {window} days" if window else "everything"
+            print(f"distribution over {label:<14} {elapsed * 1000:.2f}ms")
+
+
+# ================= BIGBANG =================
+async def run_bigbang(users):
+    """
+    Fill a throwaway data dir with `users` users (database rows, sync
+    histories, legacy files), reset it with the admin's bigbang and time
+    the reset, the event loop's longest stall meanwhile, and the
+    background deletion of the snapshot.
+    """
+    with tempfile.TemporaryDirectory() as root:
+        data_dir = os.path.join(root, "data")
+        os.environ["DVOIKA_SNAPSHOTS"] = os.path.join(root, "snapshots")
+        # nothing is kept, so the prune after the reset deletes the snapshot
+        os.environ["SNAPSHOTS_KEEP"] = "0"
+        bot, _ = load_bot(data_dir)
+        await bot.on_startup(bot.dp)
+
+        started = time.perf_counter()
+        with bot.db.lock, bot.db.conn:
+            bot.db.conn.executemany("INSERT INTO current (uid, text) VALUES (?, ?)",
+                                    ((uid, f"idea {uid}") for uid in range(users)))
+            bot.db.conn.executemany("INSERT INTO tasks (uid, text) VALUES (?, ?)",
+                                    ((uid, f"task {n}") for uid in range(users) for n in range(5)))
+        for uid in range(users):
+            bot.checkins.append(uid, {})
+            with open(os.path.join(data_dir, f"h{uid}.txt"), "w") as f:
+                f.write("history\n")
+        print(f"{users} users written in {time.perf_counter() - started:.1f}s")
+
+        loop = asyncio.get_running_loop()
+        stalls = []
+
+        async def ticker():
+            while True:
+                before = loop.time()
+                await asyncio.sleep(0.001)
+                stalls.append(loop.time() - before - 0.001)
+
+        tick = asyncio.create_task(ticker())
+        await asyncio.sleep(0.05)
+        stalls.clear()
+        started = time.perf_counter()
+        await feed(bot, message_update(bot.ADMIN_UID, "bigbang"))
+        elapsed = time.perf_counter() - started
+        tick.cancel()
+        print(f"bigbang: {elapsed * 1000:.1f}ms, longest event loop stall {max(stalls) * 1000:.1f}ms")
+
+        started = time.perf_counter()
+        for thread in threading.enumerate():
+            if thread.name == "snapshots":
+                thread.join()
+        print(f"snapshot deleted in the background in {time.perf_counter() - started:.2f}s")
+        left = bot.db.conn.execute("SELECT COUNT(*) FROM current").fetchone()[0]
+        print(f"users left: {left}, ideas kept: {len(await bot.activity.root())}")
+        await shutdown(bot)
+
+
+# ================= CRASH =================
+CRASH_USERS = 4
+
+
+def _crash_backend(directory):
+    from store import SQLiteBackend
+
+    def files_for(uid):
+        return {key: os.path.join(directory, f"{uid}{key}.txt") for key in ("rt", "p", "c", "j", "s")}
+
+    return SQLiteBackend(os.path.join(directory, "dvoika.sqlite3"), directory,
+                         os.path.join(directory, "rt.txt"), files_for)
+
+
+def _crash_writer(directory, size):
+    from store import UserStore
+
+    async def write():
+        activity = UserStore(_crash_backend(directory))
+        for version in itertools.count():
+            for uid in range(CRASH_USERS):
+                user = await activity.get(uid)
+                for i in range(size):
+                    user.add(f"v{version} task {i}")
+            await activity.flush()
+
+    asyncio.run(write())
+
+
+def run_crash(rounds, size):
+    """
+    Kill a process flushing UserStore changes to the SQLite store at a
+    random moment, then reopen the database and check that every user
+    loads with whole flushes only: each flush adds `size` tasks per user.
+    WAL commits a flush as one transaction, and synchronous=NORMAL only
+    risks the last commits on power loss, not a torn one. Returns whether
+    every load was whole.
+    """
+    import multiprocessing
+    import signal
+
+    broken = 0
+    for _ in range(rounds):
+        with tempfile.TemporaryDirectory() as directory:
+            proc = multiprocessing.Process(target=_crash_writer, args=(directory, size))
+            proc.start()
+            time.sleep(random.uniform(0.2, 0.6))
+            os.kill(proc.pid, signal.SIGKILL)
+            proc.join()
+            try:
+                backend = _crash_backend(directory)
+                users = [backend.load(uid) for uid in range(CRASH_USERS)]
+                backend.close()
+            except sqlite3.Error:
+                broken += 1
+                continue
+            for user in users:
+                versions = Counter(task.split()[0] for task in user.rt)
+                if any(count != size for count in versions.values()):
+                    broken += 1
+    print(f"{rounds} kills mid-flush: {broken} users loaded with a partial flush")
+    return not broken
+
+
+# ================= RACE =================
+async def run_race(rounds, taps):
+    global track_messages
+    # a tap has to come with the card it was pressed on
+    track_messages = True
+    with tempfile.TemporaryDirectory() as data_dir:
+        bot, _ = load_bot(data_dir)
+        await bot.on_startup(bot.dp)
+
+        uid = 42
+        for update in [message_update(uid, "/start"), message_update(uid, "🐱"),
+                       callback_update(uid, "main"), callback_update(uid, "get")]:
+            await feed(bot, update)
+
+        user = await bot.activity.get(uid)
+        failures = 0
+        # Each round discards one card and completes one task. Stop before
+        # the pool runs dry: an empty list is reseeded from ROOT_RT.
+        rounds = min(rounds, (len(user.rt) - 1) // 2)
+        for _ in range(rounds):
+            before = Counter(user.rt + user.p + user.c)
+            # only the card the taps were pressed on goes
+            shown = (await bot.dp.storage.get_data(chat=uid, user=uid))["task"]
+            await asyncio.gather(*(feed(bot, callback_update(uid, "discard")) for _ in range(taps)))
+            expected = before - Counter([shown])
+            for data in ("keep", "done"):
+                await asyncio.gather(*(feed(bot, callback_update(uid, data)) for _ in range(taps)))
+            if Counter(user.rt + user.p + user.c) != expected:
+                failures += 1
+
+        locks = len(bot.user_locks)
+        print(f"{rounds} rounds of {taps} concurrent discard/keep/done taps: "
+              f"{failures} rounds lost or duplicated tasks, "
+              f"{len(user.c)} completed, {locks} locks left")
+        await shutdown(bot)
+        return not failures and not locks
+
+
+# ================= WEBHOOK LOAD =================
+async def run_webhook(url, users, concurrency, uid_base):
+    latencies = []
+    sem = asyncio.Semaphore(concurrency)
+    flows = list(FLOWS)
+
+    async def virtual_user(session, i):
+        async with sem:
+            for update in flow_updates(uid_base + i, flows[i % len(flows)]):
+                started = time.perf_counter()
+                async with session.post(url, json=update) as resp:
+                    await resp.read()
+                    resp.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*(virtual_user(session, i) for i in range(users)))
+    elapsed = time.perf_counter() - started
+
+    p = percentiles(latencies)
+    print(f"{len(latencies)} updates from {users} users in {elapsed:.2f}s "
+          f"= {len(latencies) / elapsed:.1f} updates/sec")
+    print(f"latency p50={p[50] * 1000:.1f}ms p95={p[95] * 1000:.1f}ms p99={p[99] * 1000:.1f}ms")
+
+
+# ================= API CALLS PER FLOW =================
+async def run_api_calls():
+    global track_messages
+    track_messages = True
+    with tempfile.TemporaryDirectory() as data_dir:
+        bot, calls = load_bot(data_dir)
+        await bot.on_startup(bot.dp)
+        # admin digests are not part of any flow
+        bot.notifier.push = lambda msg: None
+        total = Counter()
+        for i, flow in enumerate(API_FLOWS):
+            calls.clear()
+            for update in flow_updates(7000 + i, flow):
+                await feed(bot, update)
+            total.update(calls)
+            methods = ", ".join(f"{method} {n}" for method, n in calls.most_common())
+            print(f"{flow:<10} {sum(calls.values()):>3} calls  {methods}")
+        print(f"{'total':<10} {sum(total.values()):>3} calls")
+        await shutdown(bot)
+
+
+# ================= OUTGOING CLIENT =================
+async def run_client(chats, messages, chat_limit, global_limit, drop, port):
+    """
+    Send `messages` to each of `chats` chats at once through a plain Bot,
+    PacedBot without pacing (retries only) and PacedBot, against a fake
+    API enforcing the limits.
+    """
+    from aiogram import Bot
+    from aiogram.bot.api import TelegramAPIServer
+    from tgclient import PacedBot
+
+    server = TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")
+    clients = {
+        "plain": lambda: Bot(FAKE_TOKEN, server=server),
+        "retry": lambda: PacedBot(FAKE_TOKEN, server=server, chat_rate=0, global_rate=0),
+        "paced": lambda: PacedBot(FAKE_TOKEN, server=server, chat_rate=chat_limit,
+                                  global_rate=global_limit),
+    }
+    for name, make in clients.items():
+        app = make_fake_api(chat_limit, global_limit, drop)
+        api = web.AppRunner(app)
+        await api.setup()
+        await web.TCPSite(api, "127.0.0.1", port).start()
+        client = make()
+        failed = Counter()
+
+        async def chat(chat_id):
+            for n in range(messages):
+                try:
+                    await client.send_message(chat_id, f"{n}")
+                except Exception as e:
+                    failed[type(e).__name__] += 1
+
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(chat(9000 + i) for i in range(chats)))
+        finally:
+            elapsed = time.perf_counter() - started
+            await client.close()
+            await api.cleanup()
+
+        sent = app["sent"]
+        delivered = sum(len(texts) for texts in sent.values())
+        in_order = sum(texts == sorted(texts, key=int) for texts in sent.values())
+        calls = app["calls"]
+        print(f"{name:<6} {delivered}/{chats * messages} delivered in {elapsed:.2f}s, "
+              f"{calls['(429)']} x 429, {calls['(dropped)']} dropped, "
+              f"{in_order}/{len(sent)} chats in order, failed: {dict(failed) or 0}")
+
+
+# ================= SHARDED WEBHOOK =================
+async def wait_for_port(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return
+
+
+async def run_shards(worker_counts, users, concurrency, port):
+    """Webhook load against a sharded bot.py, once per worker count."""
+    api = web.AppRunner(make_fake_api())
+    await api.setup()
+    await web.TCPSite(api, "127.0.0.1", port - 1).start()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    url = f"http://127.0.0.1:{port}/webhook"
+
+    try:
+        for workers in worker_counts:
+            with tempfile.TemporaryDirectory() as data_dir:
+                env = dict(
+                    os.environ,
+                    BOT_MODE="sharded",
+                    SHARDS=str(workers),
+                    DVOIKA_DATA=data_dir,
+                    TELEGRAM_API=f"http://127.0.0.1:{port - 1}",
+                    # the fake API has no limits to keep under
+                    TELEGRAM_CHAT_RATE="0",
+                    TELEGRAM_GLOBAL_RATE="0",
+                    WEBHOOK_HOST="",
+                    WEBAPP_PORT=str(port),
+                )
+                front = await asyncio.create_subprocess_exec(
+                    sys.executable, script, env=env,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+                )
+                try:
+                    for shard_port in range(port, port + workers + 1):
+                        await wait_for_port("127.0.0.1", shard_port)
+                    print(f"--- {workers} worker(s), {os.cpu_count()} core(s)")
+                    await run_webhook(url, users, concurrency, uid_base=100000)
+                finally:
+                    front.terminate()
+                    await front.wait()
+    finally:
+        await api.cleanup()
+
+
+# ================= CLI =================
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    api = sub.add_parser("fake-api", help="run a fake Bot API server")
+    api.add_argument("--host", default="127.0.0.1")
+    api.add_argument("--port", type=int, default=8081)
+
+    hook = sub.add_parser("webhook", help="POST synthetic updates to a webhook")
+    hook.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    hook.add_argument("--users", type=int, default=200)
+    hook.add_argument("--concurrency", type=int, default=50)
+    hook.add_argument("--uid-base", type=int, default=int(time.time()) * 1000)
+
+    load = sub.add_parser("load", help="offline throughput run through the Dispatcher")
+    load.add_argument("--users", type=int, default=5000)
+    load.add_argument("--concurrency", type=int, default=500)
+    load.add_argument("--disk-delay", type=float, default=0, help="ms added to each storage call")
+
+    lat = sub.add_parser("latency", help="in-process per-update latency under load")
+    lat.add_argument("--users", type=int, default=200)
+    lat.add_argument("--disk-delay", type=float, default=0, help="ms added to each storage call")
+
+    hist = sub.add_parser("checkins", help="sync history size and query time")
+    hist.add_argument("--years", type=int, default=10)
+
+    shard = sub.add_parser("shards", help="webhook load against 1 vs N worker processes")
+    shard.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 2])
+    shard.add_argument("--users", type=int, default=400)
+    shard.add_argument("--concurrency", type=int, default=100)
+    shard.add_argument("--port", type=int, default=8090, help="front port; fake API on port-1")
+
+    sub.add_parser("api-calls", help="Bot API calls per scripted flow")
+
+    client = sub.add_parser("client", help="outgoing sends against a rate-limited fake API")
+    client.add_argument("--chats", type=int, default=20)
+    client.add_argument("--messages", type=int, default=6)
+    client.add_argument("--chat-limit", type=float, default=1, help="sends per chat per second")
+    client.add_argument("--global-limit", type=float, default=30, help="sends per second")
+    client.add_argument("--drop", type=float, default=0.02, help="share of connections cut")
+    client.add_argument("--port", type=int, default=8089)
+
+    bang = sub.add_parser("bigbang", help="time the data reset on a big data dir")
+    bang.add_argument("--users", type=int, default=20000)
+
+    crash = sub.add_parser("crash", help="kill the store mid-flush and check it reloads whole")
+    crash.add_argument("--rounds", type=int, default=20)
+    crash.add_argument("--lines", type=int, default=200, help="tasks per user per flush")
+
+    race = sub.add_parser("race", help="concurrent duplicate callbacks for one user")
+    race.add_argument("--rounds", type=int, default=50)
+    race.add_argument("--taps", type=int, default=5)
+
+    args = parser.parse_args()
+    if args.command == "fake-api":
+        web.run_app(make_fake_api(), host=args.host, port=args.port)
+    elif args.command == "webhook":
+        asyncio.run(run_webhook(args.url, args.users, args.concurrency, args.uid_base))
+    elif args.command == "load":
+        asyncio.run(run_load(args.users, args.concurrency, args.disk_delay))
+    elif args.command == "latency":
+        asyncio.run(run_latency(args.users, args.disk_delay))
+    elif args.command == "checkins":
+        run_checkins(args.years)
+    elif args.command == "shards":
+        asyncio.run(run_shards(args.workers, args.users, args.concurrency, args.port))
+    elif args.command == "api-calls":
+        asyncio.run(run_api_calls())
+    elif args.command == "client":
+        asyncio.run(run_client(args.chats, args.messages, args.chat_limit,
+                               args.global_limit, args.drop, args.port))
+    elif args.command == "bigbang":
+        asyncio.run(run_bigbang(args.users))
+    elif args.command == "crash":
+        if not run_crash(args.rounds, args.lines):
+            sys.exit(1)
+    elif args.command == "race":
+        if not asyncio.run(run_race(args.rounds, args.taps)):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
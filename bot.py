@@ -1,29 +1,92 @@
+import asyncio
+import contextlib
+import functools
 import logging
 import random
-import shutil
+import signal
 import os
-import glob
+import io
+import json
 import re
+import tempfile
+import time
 
-from aiogram import Bot, Dispatcher, executor, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram import Dispatcher, executor, types
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.utils.exceptions import (
+    MessageCantBeEdited,
+    MessageNotModified,
+    MessageToEditNotFound,
+)
+from collections import OrderedDict, namedtuple
+
 from bot_token import BOT_TOKEN
+from checkins import CheckinLog
+from export import write_export
+from recommend import Sampler, TagIndex, load_overrides
+from fsm_storage import SQLiteStorage
+from metrics import MetricsMiddleware, Profiler, Registry, instrument, instrument_api
+from metrics import serve as serve_metrics
+from store import SQLiteBackend, UserStore, read_lines
+import shards
+import snapshots
+from tgclient import PacedBot
 
 logging.basicConfig(level=logging.INFO)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATA_DIR = os.path.join(BASE_DIR, "data")
+DATA_DIR = os.environ.get("DVOIKA_DATA", os.path.join(BASE_DIR, "data"))
 ROOT_RT = os.path.join(BASE_DIR, "rt.txt")
 TOPICS_FILE = os.path.join(BASE_DIR, "topics.txt")
+TAGS_FILE = os.path.join(BASE_DIR, "tags.txt")
+DATA_DB = os.path.join(DATA_DIR, "dvoika.sqlite3")
 os.makedirs(DATA_DIR, exist_ok=True)
 
 
 ADMIN_UID = 1049416300
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(bot, storage=MemoryStorage())
+# BOT_MODE=webhook serves updates from an aiohttp app on WEBAPP_HOST:WEBAPP_PORT
+# at WEBHOOK_PATH; WEBHOOK_HOST is the public base URL registered with Telegram
+# (leave empty when something else sets the webhook). TELEGRAM_API points the
+# bot at another Bot API server, e.g. `python bench.py fake-api`.
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBAPP_HOST = os.environ.get("WEBAPP_HOST", "127.0.0.1")
+WEBAPP_PORT = int(os.environ.get("WEBAPP_PORT", "8080"))
+TELEGRAM_API = os.environ.get("TELEGRAM_API")
+# Outgoing messages per second, per chat and for the whole bot (0: unpaced).
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", "30"))
+
+# BOT_MODE=sharded serves the webhook from a front process that forwards
+# each update to one of SHARDS worker processes by user id (see shards.py).
+# Workers run with SHARD set and keep their FSM state in a file of their own.
+SHARDS = int(os.environ.get("SHARDS", "1"))
+SHARD = int(os.environ.get("SHARD", "0"))
+FSM_DB = os.path.join(DATA_DIR, f"fsm.{SHARD}.sqlite3" if SHARD else "fsm.sqlite3")
+SHARDED_WORKER = "SHARD" in os.environ
+
+# bigbang moves DATA_DIR into SNAPSHOT_DIR (same filesystem) and starts an
+# empty one. The newest SNAPSHOTS_KEEP snapshots are kept, none older than
+# SNAPSHOTS_DAYS.
+SNAPSHOT_DIR = os.environ.get("DVOIKA_SNAPSHOTS", DATA_DIR.rstrip(os.sep) + "-snapshots")
+SNAPSHOTS_KEEP = int(os.environ.get("SNAPSHOTS_KEEP", "5"))
+SNAPSHOTS_DAYS = float(os.environ.get("SNAPSHOTS_DAYS", "30"))
+
+# METRICS_PORT serves GET /metrics (Prometheus text) and /profile on
+# WEBAPP_HOST; shard N listens on METRICS_PORT+N. Unset means no endpoint.
+METRICS_PORT = os.environ.get("METRICS_PORT")
+
+bot = PacedBot(
+    token=BOT_TOKEN,
+    server=TelegramAPIServer.from_base(TELEGRAM_API) if TELEGRAM_API else TELEGRAM_PRODUCTION,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    global_rate=TELEGRAM_GLOBAL_RATE,
+)
+dp = Dispatcher(bot, storage=SQLiteStorage(FSM_DB))
 
 
 # ================= STATES =================
@@ -48,11 +111,86 @@ class Flow(StatesGroup):
 
 
 # ================= ADMIN NOTIFY =================
-async def notify_admin(user_id: int, hashtag: str, text: str = ""):
+class AdminNotifier:
+    """
+    Background delivery of admin notifications.
+
+    Events are queued without waiting for Telegram. A worker collects
+    everything that arrives within `window` seconds into one digest.
+    Pacing and retries on RetryAfter and network errors are left to the
+    PacedBot it sends through; a digest that still fails is dropped.
+    """
+
+    MAX_LEN = 4096
+
+    def __init__(self, bot, chat_id, window=3.0):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.window = window
+        self.queue = asyncio.Queue()
+        self._task = None
+
+    def push(self, msg):
+        self.queue.put_nowait(msg)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def close(self):
+        """Deliver whatever is still queued and stop the worker."""
+        if self._task is None:
+            return
+        self.queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            if batch[0] is not None:
+                await asyncio.sleep(self.window)
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            closing = None in batch
+            await self._deliver([msg for msg in batch if msg is not None])
+            if closing:
+                return
+
+    async def _deliver(self, batch):
+        for digest in self._digests(batch):
+            await self._send(digest)
+
+    def _digests(self, batch):
+        chunk = ""
+        for msg in batch:
+            msg = msg[:self.MAX_LEN]
+            if chunk and len(chunk) + 2 + len(msg) > self.MAX_LEN:
+                yield chunk
+                chunk = ""
+            chunk = f"{chunk}\n\n{msg}" if chunk else msg
+        if chunk:
+            yield chunk
+
+    async def _send(self, text):
+        try:
+            await self.bot.send_message(self.chat_id, text)
+        except Exception:
+            # out of retries, ChatNotFound, BotBlocked, ...: drop this digest,
+            # keep the worker
+            logging.exception("Dropped admin notification")
+
+
+# the workers share Telegram's per-chat limit on the admin chat
+notifier = AdminNotifier(bot, ADMIN_UID)
+
+
+def notify_admin(user_id: int, hashtag: str, text: str = ""):
     msg = f"{user_id} #{hashtag}"
     if text:
         msg += f"\n{text}"
-    await bot.send_message(ADMIN_UID, msg)
+    notifier.push(msg)
 
 
 # ================= HELPERS =================
@@ -62,75 +200,249 @@ def user_files(user_id):
         "rt": os.path.join(DATA_DIR, f"{user_id}rt.txt"),
         "p": os.path.join(DATA_DIR, f"{user_id}p.txt"),
         "c": os.path.join(DATA_DIR, f"{user_id}c.txt"),
+        "j": os.path.join(DATA_DIR, f"{user_id}j.txt"),
+        "s": os.path.join(DATA_DIR, f"{user_id}s.json"),
     }
 
 
-def get_random_topic():
-    if not os.path.isfile(TOPICS_FILE):
-        return None
-    topics = read_lines(TOPICS_FILE)
-    if not topics:
-        return None
-    return random.choice(topics)
-
+async def run_blocking(fn, *args):
+    """Run a blocking call on the default thread pool."""
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+class TopicPool:
+    """
+    Topics from a text file, re-read only when its mtime changes.
+
+    The mtime is checked off the event loop at most every `check_every`
+    seconds. With a user id, topics are dealt from a per-user shuffled
+    deck so nothing repeats until the whole list has been shown; the decks
+    of the `capacity` users who asked most recently are kept.
+    """
+
+    def __init__(self, path, check_every=5.0, capacity=1024):
+        self.path = path
+        self.check_every = check_every
+        self.capacity = capacity
+        self.topics = []
+        self._mtime = None
+        self._checked = None
+        self._decks = OrderedDict()
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None, []
+        if mtime == self._mtime:
+            return mtime, self.topics
+        return mtime, read_lines(self.path)
+
+    async def refresh(self):
+        now = asyncio.get_running_loop().time()
+        if self._checked is not None and now - self._checked < self.check_every:
+            return
+        self._checked = now
+        mtime, topics = await run_blocking(self._load)
+        if mtime != self._mtime:
+            self.topics = topics
+            self._mtime = mtime
+            self._decks.clear()
+
+    def pick(self, uid=None):
+        if not self.topics:
+            return None
+        if uid is None:
+            return random.choice(self.topics)
+
+        deck = self._decks.get(uid)
+        if deck:
+            self._decks.move_to_end(uid)
+        else:
+            deck = list(range(len(self.topics)))
+            random.shuffle(deck)
+            self._decks[uid] = deck
+            self._decks.move_to_end(uid)
+            while len(self._decks) > self.capacity:
+                self._decks.popitem(last=False)
+        return self.topics[deck.pop()]
 
 
+topic_pool = TopicPool(TOPICS_FILE)
 
-def read_lines(path):
-    if not os.path.exists(path):
-        return []
-    with open(path, "r", encoding="utf-8") as f:
-        return [l.strip() for l in f if l.strip()]
 
+async def get_random_topic(uid=None):
+    await topic_pool.refresh()
+    return topic_pool.pick(uid)
 
-def write_lines(path, lines):
-    with open(path, "w", encoding="utf-8") as f:
-        f.write("\n".join(lines))
 
 
-def append_line(path, line):
-    """Append a line safely, always ending with a newline."""
-    with open(path, "a", encoding="utf-8") as f:
-        f.write(line.rstrip("\n") + "\n")
 
+db = SQLiteBackend(DATA_DB, DATA_DIR, ROOT_RT, user_files)
+# users a handler holds the lock of stay cached (user_locks is defined below)
+activity = UserStore(db, busy=lambda uid: uid in user_locks)
+
+
+tag_index = TagIndex(load_overrides(TAGS_FILE))
+sampler = Sampler(tag_index)
+
+
+async def ensure_user_rt(uid: int):
+    return await activity.get(uid)
+
+
+
+# ================= LOCKS =================
+class UserLocks:
+    """Per-user asyncio locks, dropped as soon as nobody holds or waits on them."""
+
+    def __init__(self):
+        self._locks = {}
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, uid):
+        entry = self._locks.get(uid)
+        if entry is None:
+            entry = self._locks[uid] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[uid]
+
+    def __len__(self):
+        return len(self._locks)
+
+    def __contains__(self, uid):
+        """Whether anyone holds or waits on the user's lock."""
+        return uid in self._locks
+
+
+user_locks = UserLocks()
+
+
+def user_locked(handler):
+    """
+    Run the handler while holding the sender's lock, one update per user
+    at a time. A button tap whose FSM state was changed by the update
+    ahead of it (a double tap) is dropped instead of being applied twice;
+    messages (/start, a typed number or idea) always run.
+    """
+    @functools.wraps(handler)
+    async def wrapper(obj, *args, **kwargs):
+        tap = isinstance(obj, types.CallbackQuery)
+        fsm = Dispatcher.get_current().current_state()
+        seen = await fsm.get_state() if tap else None
+        async with user_locks(obj.from_user.id):
+            if tap and await fsm.get_state() != seen:
+                await obj.answer()
+                return
+            return await handler(obj, *args, **kwargs)
+    return wrapper
+
+# ================= RESPONSES =================
+class Reply:
+    """
+    One message in answer to an update.
+
+    Texts added in a row are joined with a blank line; the last keyboard
+    given wins. A callback's own message is edited in place (only the
+    keyboard if the text is the same, nothing at all if both are), and a
+    new message is sent only for text messages from the user or when the
+    old one can't be edited.
+    """
+
+    def __init__(self, event):
+        self.event = event
+        self.texts = []
+        self.markup = None
+
+    def add(self, text, reply_markup=None):
+        self.texts.append(text)
+        if reply_markup is not None:
+            self.markup = reply_markup
+        return self
 
-def ensure_root_rt():
-    if not os.path.isfile(ROOT_RT):
-        with open(ROOT_RT, "w", encoding="utf-8"):
-            pass
+    async def send(self):
+        text = "\n\n".join(self.texts)
+        if not isinstance(self.event, types.CallbackQuery):
+            return await self.event.answer(text, reply_markup=self.markup)
+
+        message = self.event.message
+        if message.text is not None:
+            try:
+                if message.text != text:
+                    return await message.edit_text(text, reply_markup=self.markup)
+                if not same_markup(message.reply_markup, self.markup):
+                    return await message.edit_reply_markup(self.markup)
+                return message
+            except MessageNotModified:
+                return message
+            except (MessageCantBeEdited, MessageToEditNotFound):
+                pass
+        return await message.answer(text, reply_markup=self.markup)
+
+
+def same_markup(current, markup):
+    """Whether a message's keyboard is `markup` (JSON string, object or None)."""
+    if current is None or markup is None:
+        return current is None and markup is None
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    elif not isinstance(markup, dict):
+        markup = markup.to_python()
+    return current.to_python() == markup
+
+
+async def reply(event, *parts):
+    """Send `parts` (text, or (text, keyboard)) as one Reply."""
+    response = Reply(event)
+    for part in parts:
+        if isinstance(part, tuple):
+            response.add(*part)
+        else:
+            response.add(part)
+    return await response.send()
 
 
-def ensure_user_rt(uid: int):
-    ensure_root_rt()
-    files = user_files(uid)
+EMOJI_DIGITS = {
+    "0": "0️⃣",
+    "1": "1️⃣",
+    "2": "2️⃣",
+    "3": "3️⃣",
+    "4": "4️⃣",
+    "5": "5️⃣",
+    "6": "6️⃣",
+    "7": "7️⃣",
+    "8": "8️⃣",
+    "9": "9️⃣",
+}
 
-    for key in ("rt", "p", "c"):
-        if not os.path.isfile(files[key]):
-            with open(files[key], "w", encoding="utf-8"):
-                pass
-
-    if os.path.getsize(files["rt"]) == 0:
-        root_tasks = read_lines(ROOT_RT)
-        if root_tasks:
-            write_lines(files["rt"], root_tasks)
 
+@functools.lru_cache(maxsize=4096)
 def emoji_numbers(n: int) -> str:
-    digit_map = {
-        "0": "0️⃣",
-        "1": "1️⃣",
-        "2": "2️⃣",
-        "3": "3️⃣",
-        "4": "4️⃣",
-        "5": "5️⃣",
-        "6": "6️⃣",
-        "7": "7️⃣",
-        "8": "8️⃣",
-        "9": "9️⃣",
-    }
-    return "".join(digit_map[d] for d in str(n))
+    return "".join(EMOJI_DIGITS[d] for d in str(n))
 
 
 # ================= KEYBOARDS =================
+def static_keyboard(build):
+    """
+    Build the keyboard once and keep it serialized: the Bot API takes
+    reply_markup as a JSON string, so a click neither rebuilds nor
+    re-dumps it.
+    """
+    markup = json.dumps(build().to_python(), ensure_ascii=False)
+
+    @functools.wraps(build)
+    def cached():
+        return markup
+    return cached
+
+
+@static_keyboard
 def kb_main():
     kb = types.InlineKeyboardMarkup()
     kb.add(
@@ -143,6 +455,7 @@ def kb_main():
     return kb
 
 
+@static_keyboard
 def kb_talk_menu():
     kb = types.InlineKeyboardMarkup()
     kb.add(
@@ -154,6 +467,7 @@ def kb_talk_menu():
     return kb
 
 
+@static_keyboard
 def kb_action():
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("Отправить активность", callback_data="submit"))
@@ -162,6 +476,7 @@ def kb_action():
     return kb
 
 
+@static_keyboard
 def kb_activity():
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("Выбросить", callback_data="discard"))
@@ -169,6 +484,7 @@ def kb_activity():
     return kb
 
 
+@static_keyboard
 def kb_goal():
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("Цель выполнена", callback_data="done"))
@@ -176,6 +492,7 @@ def kb_goal():
     return kb
 
 
+@static_keyboard
 def kb_confirm_current():
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("Да", callback_data="yes"))
@@ -183,34 +500,139 @@ def kb_confirm_current():
     return kb
 
 
-def kb_list_menu():
+# ================= LIST PAGES =================
+# Lists are shown PAGE_SIZE tasks at a time with prev/next buttons; numbers
+# stay global, so "choose" and "delete" take numbers from any page. Each
+# rendered page is cached under the list's version, so paging never
+# renders more than one page and an unchanged list renders nothing.
+PAGE_SIZE = 10
+ITEM_PREVIEW = 300
+LIST_PAGES_CACHED = 2048
+LIST_TITLES = {
+    "list": "Список активностей",
+    "choose": "Введите номер активности",
+    "delete": "Введите номера для удаления (через пробел или запятую)",
+}
+
+list_pages = OrderedDict()  # (uid, list version, mode, page) -> (text, markup)
+
+
+def page_count(user):
+    return max(1, -(-len(user.rt) // PAGE_SIZE))
+
+
+def list_page(user, mode, page):
+    """Text and keyboard (JSON) of one page of user.rt, 0-based."""
+    page = min(max(page, 0), page_count(user) - 1)
+    key = (user.uid, user.version, mode, page)
+    cached = list_pages.get(key)
+    if cached is not None:
+        list_pages.move_to_end(key)
+        return cached
+
+    pages = page_count(user)
+    start = page * PAGE_SIZE
+    lines = []
+    for i, task in enumerate(user.rt[start:start + PAGE_SIZE], start + 1):
+        if len(task) > ITEM_PREVIEW:
+            task = task[:ITEM_PREVIEW] + "…"
+        lines.append(f"{emoji_numbers(i)} {task}")
+    header = LIST_TITLES[mode] + (f" ({page + 1}/{pages})" if pages > 1 else "")
+
     kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton("🎲 Выбрать случайно", callback_data="get"))
-    kb.add(types.InlineKeyboardButton("Выбрать активность", callback_data="choose"))
-    kb.add(types.InlineKeyboardButton("Удалить активности", callback_data="delete"))
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(types.InlineKeyboardButton("◀", callback_data=f"page:{mode}:{page - 1}"))
+        nav.append(types.InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"page:{mode}:{page}"))
+        if page < pages - 1:
+            nav.append(types.InlineKeyboardButton("▶", callback_data=f"page:{mode}:{page + 1}"))
+        kb.row(*nav)
+    if mode == "list":
+        kb.add(types.InlineKeyboardButton("🎲 Выбрать случайно", callback_data="get"))
+        kb.add(types.InlineKeyboardButton("Выбрать активность", callback_data=f"choose:{page}"))
+        kb.add(types.InlineKeyboardButton("Удалить активности", callback_data=f"delete:{page}"))
     kb.add(types.InlineKeyboardButton("⬅ Назад", callback_data="back_to_action"))
-    return kb
+
+    rendered = list_pages[key] = (
+        header + ":\n" + "\n".join(lines),
+        json.dumps(kb.to_python(), ensure_ascii=False),
+    )
+    while len(list_pages) > LIST_PAGES_CACHED:
+        list_pages.popitem(last=False)
+    return rendered
+
+
+@dp.callback_query_handler(lambda c: c.data.startswith("page:"), state="*")
+async def list_page_nav(cb: types.CallbackQuery):
+    _, mode, page = cb.data.split(":")
+    user = await ensure_user_rt(cb.from_user.id)
+    # the counter button, or a page that did not change, edits nothing
+    await reply(cb, list_page(user, mode, int(page)))
+    await cb.answer()
 
 
 @dp.callback_query_handler(lambda c: c.data == "back_to_action", state="*")
 async def back_to_action(cb: types.CallbackQuery):
-    await cb.message.edit_text("Выберите действие:", reply_markup=kb_action())
+    await reply(cb, ("Выберите действие:", kb_action()))
     await Flow.action.set()
     await cb.answer()
 
 
+def swap_data_dir():
+    """Move DATA_DIR into a snapshot and reopen the activity database in the empty one."""
+    path = snapshots.snapshot_path(SNAPSHOT_DIR)
+    db.reopen(
+        between=lambda: snapshots.swap(DATA_DIR, path),
+        ideas_from=os.path.join(path, os.path.basename(DATA_DB)),
+    )
+    logging.warning("Data reset, the old data is in %s", path)
+
+
+def prune_snapshots():
+    snapshots.prune_in_background(SNAPSHOT_DIR, SNAPSHOTS_KEEP, SNAPSHOTS_DAYS * snapshots.DAY)
+
+
+async def reset_data():
+    """
+    Start every user from scratch, keeping the idea pool. The FSM
+    database is closed first and both reopen in the new DATA_DIR; caches
+    go with them.
+    """
+    await dp.storage.reopen(swap_data_dir)
+    await activity.reset()
+    checkins.reopen()
+    list_pages.clear()
+    prune_snapshots()
+
+
+def reset_front():
+    swap_data_dir()
+    prune_snapshots()
+
+
 @dp.message_handler(lambda m: m.text and m.text.lower() == "bigbang", state="*")
 async def bigbang(message: types.Message, state: FSMContext):
+    if message.from_user.id != ADMIN_UID:
+        return
+
+    if SHARDED_WORKER:
+        await message.answer("💥 Вселенная пересобирается. Через пару секунд — /start")
+        # the other workers have the data open too: the front restarts us all
+        os.kill(os.getppid(), signal.SIGUSR1)
+        return
+
+    try:
+        await reset_data()
+    except OSError:
+        # the old data stays in place and in use
+        logging.exception("Data reset failed")
+        await message.answer("⚠️ Не удалось пересобрать вселенную, данные не тронуты. Подробности в логе.")
+        return
     await state.finish()
     await state.reset_data()
 
-    # Delete all txt files in DATA_DIR 
-    for file in glob.glob(os.path.join(DATA_DIR, "*.txt")):
-        os.remove(file)
-            
-
-    await message.answer("💥 Вселенная пересобрана.")
-    await message.answer("Привет. Введи пароль: эмоцзи того, кому разрешен доступ")
+    await reply(message, "💥 Вселенная пересобрана.", "Привет. Введи пароль: эмоцзи того, кому разрешен доступ")
     await Flow.password.set()
 
 
@@ -218,23 +640,17 @@ async def bigbang(message: types.Message, state: FSMContext):
 async def talk_start(cb: types.CallbackQuery):
     uid = cb.from_user.id
 
-    await notify_admin(uid, "talk")
+    notify_admin(uid, "talk")
 
-    topic = get_random_topic()
+    topic = await get_random_topic(uid)
     if not topic:
-        await cb.message.answer(
-            "Темы для разговора пока не найдены.",
-            reply_markup=kb_main()
-        )
+        await reply(cb, ("Темы для разговора пока не найдены.", kb_main()))
         await cb.answer()
         return
 
-    await notify_admin(uid, "topic", topic)
+    notify_admin(uid, "topic", topic)
 
-    await cb.message.edit_text(
-        f"💬 Тема для разговора:\n\n{topic}",
-        reply_markup=kb_talk_menu()
-    )
+    await reply(cb, (f"💬 Тема для разговора:\n\n{topic}", kb_talk_menu()))
     await cb.answer()
 
 
@@ -242,36 +658,28 @@ async def talk_start(cb: types.CallbackQuery):
 async def new_topic(cb: types.CallbackQuery):
     uid = cb.from_user.id
 
-    topic = get_random_topic()
+    topic = await get_random_topic(uid)
     if not topic:
-        await cb.message.answer(
-            "Темы закончились.",
-            reply_markup=kb_main()
-        )
+        await reply(cb, ("Темы закончились.", kb_main()))
         await cb.answer()
         return
 
-    await notify_admin(uid, "topic", topic)
+    notify_admin(uid, "topic", topic)
 
-    await cb.message.edit_text(
-        f"💬 Новая тема:\n\n{topic}",
-        reply_markup=kb_talk_menu()
-    )
+    await reply(cb, (f"💬 Новая тема:\n\n{topic}", kb_talk_menu()))
     await cb.answer()
 
 
 @dp.callback_query_handler(lambda c: c.data == "back_to_main", state="*")
 async def back_to_main(cb: types.CallbackQuery, state: FSMContext):
-    await cb.message.edit_text(
-        "Выбери режим",
-        reply_markup=kb_main()
-    )
+    await reply(cb, ("Выбери режим", kb_main()))
     await Flow.main.set()
     await cb.answer()
 
 
 
 
+@static_keyboard
 def kb_sync_energy():
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -283,6 +691,7 @@ def kb_sync_energy():
     return kb
 
 
+@static_keyboard
 def kb_sync_weather():
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -294,6 +703,7 @@ def kb_sync_weather():
     return kb
 
 
+@static_keyboard
 def kb_sync_social():
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -305,6 +715,7 @@ def kb_sync_social():
     return kb
 
 
+@static_keyboard
 def kb_sync_focus():
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -316,6 +727,7 @@ def kb_sync_focus():
     return kb
 
 
+@static_keyboard
 def kb_sync_time():
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -327,6 +739,7 @@ def kb_sync_time():
     return kb
 
 
+@static_keyboard
 def kb_sync_desire():
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -339,6 +752,7 @@ def kb_sync_desire():
     return kb
 
 
+@static_keyboard
 def kb_sync_intensity():
     kb = types.InlineKeyboardMarkup(row_width=3)
     kb.add(
@@ -349,6 +763,7 @@ def kb_sync_intensity():
     return kb
 
 
+@static_keyboard
 def kb_sync_word():
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -367,26 +782,140 @@ def kb_sync_word():
     return kb
 
 
+# state -> its question, the key its answer is kept under and what comes next
+SyncStep = namedtuple("SyncStep", "hashtag prompt keyboard next_state")
+
+SYNC_STEPS = {
+    Flow.sync_energy.state: SyncStep(
+        "energy", "Как сейчас с энергией?", kb_sync_energy(), Flow.sync_weather),
+    Flow.sync_weather.state: SyncStep(
+        "weather", "🌦 Если настроение — погода, то какая?", kb_sync_weather(), Flow.sync_social),
+    Flow.sync_social.state: SyncStep(
+        "social", "👥 Люди сегодня — это…", kb_sync_social(), Flow.sync_focus),
+    Flow.sync_focus.state: SyncStep(
+        "focus", "🎯 Что сейчас просит внимания?", kb_sync_focus(), Flow.sync_time),
+    Flow.sync_time.state: SyncStep(
+        "time", "⏳ Сколько у тебя есть времени?", kb_sync_time(), Flow.sync_desire),
+    Flow.sync_desire.state: SyncStep(
+        "desire", "🧭 Чего ты хочешь прямо сейчас?", kb_sync_desire(), Flow.sync_intensity),
+    Flow.sync_intensity.state: SyncStep(
+        "intensity", "🔥 Насколько интенсивно?", kb_sync_intensity(), Flow.sync_word),
+    Flow.sync_word.state: SyncStep(
+        "word", "📝 Какое слово сейчас ближе всего?", kb_sync_word(), None),
+}
+
+
+SYNC_FIELDS = {step.hashtag for step in SYNC_STEPS.values()}
+
+
+def keyboard_answers(markup):
+    return [
+        button["callback_data"]
+        for row in json.loads(markup)["inline_keyboard"]
+        for button in row
+    ]
+
+
+# Answers are stored as their position on the keyboard: add new buttons
+# and new steps at the end.
+checkins = CheckinLog(
+    os.path.join(DATA_DIR, "checkins"),
+    [(step.hashtag, keyboard_answers(step.keyboard)) for step in SYNC_STEPS.values()],
+)
+
+
+@dp.message_handler(commands=["sync_stats"], state="*")
+async def sync_stats(message: types.Message):
+    if message.from_user.id != ADMIN_UID:
+        return
+
+    args = message.get_args().split()
+    if not args or not all(arg.isdigit() for arg in args):
+        await message.answer("/sync_stats <uid> [дней]")
+        return
+    uid = int(args[0])
+    days = int(args[1]) if len(args) > 1 else None
+
+    total = await run_blocking(checkins.count, uid, days)
+    dist = await run_blocking(checkins.distribution, uid, days)
+    period = f"за {days} дн." if days else "за всё время"
+    lines = [f"{uid} #sync_stats {period}: {total}"]
+    for field, counts in dist.items():
+        if counts:
+            top = ", ".join(f"{answer} {n}" for answer, n in counts.most_common())
+            lines.append(f"{field}: {top}")
+    await message.answer("\n".join(lines))
+
+
+@dp.message_handler(commands=["export"], state="*")
+async def export(message: types.Message):
+    if message.from_user.id != ADMIN_UID:
+        return
+
+    await message.answer("Собираю выгрузку…")
+    # pending list changes go to the database first
+    await activity.flush()
+    with tempfile.TemporaryFile() as f:
+        users = await run_blocking(write_export, DATA_DB, checkins, f)
+        f.seek(0)
+        name = time.strftime("dvoika-%Y%m%d-%H%M.zip")
+        await message.answer_document(types.InputFile(f, filename=name), caption=f"Пользователей: {users}")
+
+
+# ================= METRICS =================
+registry = Registry()
+profiler = Profiler()
+dp.middleware.setup(MetricsMiddleware(registry, profiler))
+instrument_api(registry, bot)
+instrument(registry, db, ["load", "save", "load_root", "add_root", "reset"], "store")
+instrument(registry, dp.storage, ["_fetch", "_commit"], "fsm_storage")
+instrument(registry, checkins, ["append", "count", "records", "distribution"], "checkins")
+registry.gauge("users_cached", lambda: len(activity))
+registry.gauge("user_locks_held", lambda: len(user_locks))
+registry.gauge("admin_notify_queued", lambda: notifier.queue.qsize())
+registry.gauge("telegram_paced", lambda: bot.stats["paced"])
+registry.gauge("telegram_flood_retries", lambda: bot.stats["retry_after"])
+registry.gauge("telegram_network_retries", lambda: bot.stats["network"])
+metrics_runner = None
+
+
+@dp.message_handler(commands=["profile"], state="*")
+async def profile(message: types.Message):
+    if message.from_user.id != ADMIN_UID:
+        return
+
+    args = message.get_args().split()
+    if args and all(arg.isdigit() for arg in args):
+        uid, updates = int(args[0]), int(args[1]) if len(args) > 1 else 20
+        profiler.start(uid, updates)
+        await message.answer(f"Профилирую {updates} обновлений от {uid}. /profile — отчёт")
+        return
+    if args:
+        await message.answer("/profile <uid> [обновлений] — профилировать, /profile — отчёт")
+        return
+
+    report = profiler.stop()
+    if not report:
+        await message.answer("Отчёта пока нет")
+        return
+    await message.answer_document(types.InputFile(io.BytesIO(report.encode()), filename="profile.txt"))
 
 
 # ================= START =================
 @dp.message_handler(commands=["start"], state="*")
+@user_locked
 async def start(message: types.Message, state: FSMContext):
-    ensure_root_rt()
     await state.finish()
     await state.reset_data()
 
     uid = message.from_user.id
-    await notify_admin(uid, "start")
+    notify_admin(uid, "start")
 
-    ensure_user_rt(uid)
-    files = user_files(uid)
+    user = await ensure_user_rt(uid)
 
-    p_tasks = read_lines(files["p"])
-    if p_tasks:
-        task = p_tasks[0]
-        await message.answer(f"Ваша текущая активность:\n\n{task}")
-        await message.answer("Выберите действие:", reply_markup=kb_goal())
+    task = user.current
+    if task:
+        await reply(message, f"Ваша текущая активность:\n\n{task}", ("Выберите действие:", kb_goal()))
         await Flow.goal_decision.set()
         return
 
@@ -402,7 +931,7 @@ async def password(message: types.Message):
         return
 
     uid = message.from_user.id
-    ensure_user_rt(uid)
+    await ensure_user_rt(uid)
 
     await message.answer("Выбери режим", reply_markup=kb_main())
     await Flow.main.set()
@@ -411,7 +940,7 @@ async def password(message: types.Message):
 # ================= MAIN =================
 @dp.callback_query_handler(lambda c: c.data == "main", state=Flow.main)
 async def main(cb: types.CallbackQuery):
-    await cb.message.edit_text("Что делаем?", reply_markup=kb_action())
+    await reply(cb, ("Что делаем?", kb_action()))
     await Flow.action.set()
     await cb.answer()
 
@@ -425,60 +954,60 @@ async def main_fallback(message: types.Message):
 
 # ================= ACTION =================
 @dp.callback_query_handler(lambda c: c.data in ["get", "list", "submit"], state=Flow.action)
+@user_locked
 async def action_stage(cb: types.CallbackQuery, state: FSMContext):
     uid = cb.from_user.id
-    ensure_user_rt(uid)
-    files = user_files(uid)
+    user = await ensure_user_rt(uid)
 
     if cb.data == "get":
         await get_activity(cb, state)
         return
 
     if cb.data == "list":
-        tasks = read_lines(files["rt"])
+        tasks = user.rt
         if not tasks:
-            await cb.message.answer("Список активностей пуст.")
-            await cb.message.answer("Выберите действие:", reply_markup=kb_action())
+            await reply(cb, "Список активностей пуст.", ("Выберите действие:", kb_action()))
         else:
-            text = "\n".join(f"{emoji_numbers(i+1)} {t}" for i, t in enumerate(tasks))
-            await cb.message.answer(f"Список активностей:\n{text}")
-            await cb.message.answer("Что делать дальше?", reply_markup=kb_list_menu())
+            await reply(cb, list_page(user, "list", 0))
         await cb.answer()
         return
 
     if cb.data == "submit":
-        await cb.message.answer("Введите идею активности:")
+        await reply(cb, "Введите идею активности:")
         await Flow.submit_activity.set()
         await cb.answer()
 
 
 # ================= LIST MENU =================
-@dp.callback_query_handler(lambda c: c.data in ["choose", "delete", "get"], state="*")
+# "choose" and "delete" carry the list page they were pressed on, if any
+@dp.callback_query_handler(lambda c: c.data.split(":")[0] in ["choose", "delete", "get"], state="*")
+@user_locked
 async def list_menu(cb: types.CallbackQuery, state: FSMContext):
     uid = cb.from_user.id
-    ensure_user_rt(uid)
-    files = user_files(uid)
+    user = await ensure_user_rt(uid)
+    action, _, page = cb.data.partition(":")
+    page = int(page or 0)
 
-    if cb.data == "get":
+    if action == "get":
         await get_activity(cb, state)
         await cb.answer()
         return
 
-    if cb.data == "choose":
-        await cb.message.answer("Введите номер активности:")
+    if action == "choose":
+        # the list stays on screen, so the number can be read off it
+        await reply(cb, list_page(user, "choose", page))
+        await state.update_data(delete_mode=False)
         await Flow.choose_from_list.set()
 
-    if cb.data == "delete":
-        tasks = read_lines(files["rt"])
+    if action == "delete":
+        tasks = user.rt
         if not tasks:
-            await cb.message.answer("Список пуст.")
+            await reply(cb, "Список пуст.", ("Выберите действие:", kb_action()))
             await Flow.action.set()
+            await cb.answer()
             return
 
-        text = "\n".join(f"{emoji_numbers(i+1)} {t}" for i, t in enumerate(tasks))
-        await cb.message.answer(
-            f"{text}\n\nВведите номера для удаления (через пробел или запятую):"
-        )
+        await reply(cb, list_page(user, "delete", page))
         await state.update_data(delete_mode=True)
         await Flow.choose_from_list.set()
 
@@ -487,14 +1016,14 @@ async def list_menu(cb: types.CallbackQuery, state: FSMContext):
 
 # ================= CHOOSE / DELETE =================
 @dp.message_handler(state=Flow.choose_from_list)
+@user_locked
 async def choose_or_delete(message: types.Message, state: FSMContext):
     uid = message.from_user.id
-    ensure_user_rt(uid)
-    files = user_files(uid)
+    user = await ensure_user_rt(uid)
 
     data = await state.get_data()
     delete_mode = data.get("delete_mode", False)
-    tasks = read_lines(files["rt"])
+    tasks = user.rt
 
     nums = [int(n) for n in re.findall(r"\d+", message.text)]
     indices = sorted({n - 1 for n in nums if 1 <= n <= len(tasks)}, reverse=True)
@@ -504,123 +1033,136 @@ async def choose_or_delete(message: types.Message, state: FSMContext):
         return
 
     if delete_mode:
-        removed = []
-        for i in indices:
-            removed.append(tasks.pop(i))
-        write_lines(files["rt"], tasks)
-
-        await message.answer("Удалено:\n" + "\n".join(removed))
+        removed = user.remove_at(indices)
 
         await state.finish()
         await state.reset_data()
 
-        await message.answer("Выберите действие:", reply_markup=kb_action())
+        await reply(message, "Удалено:\n" + "\n".join(removed), ("Выберите действие:", kb_action()))
         await Flow.action.set()
         return
 
-    task = tasks.pop(indices[0])
-    write_lines(files["rt"], tasks)
-    write_lines(files["p"], [task])
+    task = tasks[indices[0]]
+    user.pick(task, indices[0])
 
-    await notify_admin(uid, "got", task)
+    notify_admin(uid, "got", task)
     await message.answer(f"Ваша текущая активность:\n\n{task}", reply_markup=kb_goal())
     await Flow.goal_decision.set()
 
 
 # ================= SUBMIT =================
 @dp.message_handler(state=Flow.submit_activity)
+@user_locked
 async def submit_activity(message: types.Message, state: FSMContext):
     uid = message.from_user.id
-    ensure_user_rt(uid)
-    files = user_files(uid)
+    user = await ensure_user_rt(uid)
 
     text = message.text.strip()
     if not text:
         await message.answer("Пустая активность.")
         return
 
-    # FIXED: use absolute path for global rt.txt
-    append_line(ROOT_RT, text)
-    append_line(files["rt"], text)
+    notify_admin(uid, "idea", text)
+    response = Reply(message)
+    text, added = await activity.add_root(text)
+    if added:
+        tag_index.add(text)
+    else:
+        response.add(f"Такая идея уже есть:\n\n{text}")
+    if not user.has(text):
+        user.add(text)
 
-    await notify_admin(uid, "idea", text)
     await state.update_data(new_idea=text)
 
-    await message.answer("Сделать её текущей?", reply_markup=kb_confirm_current())
+    await response.add("Сделать её текущей?", kb_confirm_current()).send()
     await Flow.confirm_new_current.set()
 
 
 
 # ================= CONFIRM =================
 @dp.callback_query_handler(state=Flow.confirm_new_current)
+@user_locked
 async def confirm(cb: types.CallbackQuery, state: FSMContext):
     uid = cb.from_user.id
-    ensure_user_rt(uid)
-    files = user_files(uid)
+    user = await ensure_user_rt(uid)
 
     data = await state.get_data()
     task = data.get("new_idea")
 
     if cb.data == "yes":
-        rt = read_lines(files["rt"])
-        if task in rt:
-            rt.remove(task)
-        write_lines(files["rt"], rt)
-        write_lines(files["p"], [task])
-        await notify_admin(uid, "got", task)
-        await cb.message.answer(f"Ваша активность:\n\n{task}", reply_markup=kb_goal())
+        user.pick(task)
+        notify_admin(uid, "got", task)
+        await reply(cb, (f"Ваша активность:\n\n{task}", kb_goal()))
         await Flow.goal_decision.set()
     else:
-        await cb.message.answer("Выберите действие:", reply_markup=kb_action())
+        await reply(cb, ("Выберите действие:", kb_action()))
         await Flow.action.set()
 
     await cb.answer()
 
 
 # ================= GET =================
+CARD = "Активность:\n\n"
+
+
+def activity_card(task):
+    return CARD + task
+
+
+def card_task(text):
+    """The task an activity card shows, None for any other message."""
+    return text[len(CARD):] if text and text.startswith(CARD) else None
+
+
 async def get_activity(cb: types.CallbackQuery, state: FSMContext):
     uid = cb.from_user.id
-    ensure_user_rt(uid)
-    files = user_files(uid)
+    user = await ensure_user_rt(uid)
 
-    tasks = read_lines(files["rt"])
+    tasks = user.rt
     if not tasks:
-        await cb.message.answer("Все выполнено.")
+        await reply(cb, "Все выполнено.", ("Выберите действие:", kb_action()))
         await Flow.action.set()
         return
 
-    task = random.choice(tasks)
+    # no repeats within a round, weighted by this session's sync and by
+    # what the user kept or discarded before
+    data = await state.get_data()
+    task = sampler.draw(user, data.get("last_sync", {}).values())
     await state.update_data(task=task)
-    await cb.message.answer(f"Активность:\n\n{task}", reply_markup=kb_activity())
-    await notify_admin(uid, "got", task)
+    await reply(cb, (activity_card(task), kb_activity()))
+    notify_admin(uid, "got", task)
     await Flow.activity_decision.set()
 
 
 # ================= DECISION =================
 @dp.callback_query_handler(state=Flow.activity_decision)
+@user_locked
 async def decision(cb: types.CallbackQuery, state: FSMContext):
     uid = cb.from_user.id
-    ensure_user_rt(uid)
-    files = user_files(uid)
+    user = await ensure_user_rt(uid)
 
     task = (await state.get_data())["task"]
-    rt = read_lines(files["rt"])
+
+    # "Выбросить" draws the next card in the same state, so the state check
+    # of user_locked lets a repeat tap through; the card it was pressed on
+    # tells it apart
+    shown = card_task(cb.message.text)
+    if shown is not None and shown != task:
+        await cb.answer()
+        return
 
     if cb.data == "discard":
-        await notify_admin(uid, "discarded", task)
-        if task in rt:
-            rt.remove(task)
-        write_lines(files["rt"], rt)
+        notify_admin(uid, "discarded", task)
+        sampler.learn(user, "discard", task)
+        user.remove(task)
         await get_activity(cb, state)
         return
 
     if cb.data == "keep":
-        await notify_admin(uid, "keep", task)
-        if task in rt:
-            rt.remove(task)
-        write_lines(files["rt"], rt)
-        write_lines(files["p"], [task])
-        await cb.message.answer("Активность сохранена.", reply_markup=kb_goal())
+        notify_admin(uid, "keep", task)
+        sampler.learn(user, "keep", task)
+        user.pick(task)
+        await reply(cb, (f"Активность сохранена:\n\n{task}", kb_goal()))
         await Flow.goal_decision.set()
 
     await cb.answer()
@@ -628,135 +1170,137 @@ async def decision(cb: types.CallbackQuery, state: FSMContext):
 
 # ================= GOAL =================
 @dp.callback_query_handler(state=Flow.goal_decision)
+@user_locked
 async def goal(cb: types.CallbackQuery, state: FSMContext):
     uid = cb.from_user.id
-    ensure_user_rt(uid)
-    files = user_files(uid)
+    user = await ensure_user_rt(uid)
 
-    p = read_lines(files["p"])
-    if not p:
+    if user.current is None:
         return
 
-    task = p[0]
+    # A late tap on an older keyboard (e.g. a second "keep") must not
+    # replace the current activity.
+    if cb.data not in ("done", "change"):
+        await cb.answer()
+        return
 
     if cb.data == "done":
-        c = read_lines(files["c"])
-        c.append(task)
-        write_lines(files["c"], c)
-        write_lines(files["p"], [])
-        await notify_admin(uid, "completed", task)
+        task = user.complete()
+        sampler.learn(user, "complete", task)
+        notify_admin(uid, "completed", task)
 
     if cb.data == "change":
-        rt = read_lines(files["rt"])
-        rt.append(task)
-        write_lines(files["rt"], rt)
-        write_lines(files["p"], [])
-        await notify_admin(uid, "changed", task)
+        task = user.change()
+        sampler.learn(user, "change", task)
+        notify_admin(uid, "changed", task)
 
     await get_activity(cb, state)
     await cb.answer()
 
 
 @dp.callback_query_handler(lambda c: c.data == "sync", state=Flow.main)
-async def sync_start(cb: types.CallbackQuery):
-    await cb.message.edit_text(
-        "⚡ Синхронизация\n\nКак сейчас с энергией?",
-        reply_markup=kb_sync_energy()
-    )
+async def sync_start(cb: types.CallbackQuery, state: FSMContext):
+    step = SYNC_STEPS[Flow.sync_energy.state]
+    await state.update_data(sync={})
+    await reply(cb, (f"⚡ Синхронизация\n\n{step.prompt}", step.keyboard))
     await Flow.sync_energy.set()
     await cb.answer()
 
 
-@dp.callback_query_handler(state=Flow.sync_energy)
-async def sync_energy(cb: types.CallbackQuery, state: FSMContext):
-    await notify_admin(cb.from_user.id, "energy", cb.data)
-    await cb.message.edit_text(
-        "🌦 Если настроение — погода, то какая?",
-        reply_markup=kb_sync_weather()
-    )
-    await Flow.sync_weather.set()
-    await cb.answer()
-
-
-@dp.callback_query_handler(state=Flow.sync_weather)
-async def sync_weather(cb: types.CallbackQuery, state: FSMContext):
-    await notify_admin(cb.from_user.id, "weather", cb.data)
-    await cb.message.edit_text(
-        "👥 Люди сегодня — это…",
-        reply_markup=kb_sync_social()
-    )
-    await Flow.sync_social.set()
-    await cb.answer()
-
-
-@dp.callback_query_handler(state=Flow.sync_social)
-async def sync_social(cb: types.CallbackQuery, state: FSMContext):
-    await notify_admin(cb.from_user.id, "social", cb.data)
-    await cb.message.edit_text(
-        "🎯 Что сейчас просит внимания?",
-        reply_markup=kb_sync_focus()
-    )
-    await Flow.sync_focus.set()
-    await cb.answer()
-
-
-@dp.callback_query_handler(state=Flow.sync_focus)
-async def sync_focus(cb: types.CallbackQuery, state: FSMContext):
-    await notify_admin(cb.from_user.id, "focus", cb.data)
-    await cb.message.edit_text(
-        "⏳ Сколько у тебя есть времени?",
-        reply_markup=kb_sync_time()
-    )
-    await Flow.sync_time.set()
-    await cb.answer()
+# One handler for every step: the current state picks the row in SYNC_STEPS.
+# Adding a step means adding a state and a row, no new handler.
+@dp.callback_query_handler(state=list(SYNC_STEPS))
+@user_locked
+async def sync_step(cb: types.CallbackQuery, state: FSMContext):
+    step = SYNC_STEPS[await state.get_state()]
+    if not cb.data.startswith(f"{step.hashtag}_"):
+        # a tap on an older question's keyboard
+        await cb.answer()
+        return
 
+    data = await state.get_data()
+    answers = data.get("sync", {})
+    answers[step.hashtag] = cb.data
+
+    if step.next_state is not None:
+        nxt = SYNC_STEPS[step.next_state.state]
+        await state.update_data(sync=answers)
+        await reply(cb, (nxt.prompt, nxt.keyboard))
+        await step.next_state.set()
+        await cb.answer()
+        return
 
-@dp.callback_query_handler(state=Flow.sync_time)
-async def sync_time(cb: types.CallbackQuery, state: FSMContext):
-    await notify_admin(cb.from_user.id, "time", cb.data)
-    await cb.message.edit_text(
-        "🧭 Чего ты хочешь прямо сейчас?",
-        reply_markup=kb_sync_desire()
-    )
-    await Flow.sync_desire.set()
+    await state.update_data(sync={}, last_sync=answers)
+    if answers.keys() >= SYNC_FIELDS:
+        await run_blocking(checkins.append, cb.from_user.id, answers)
+        notify_admin(cb.from_user.id, "sync", "\n".join(answers.values()))
+    else:
+        logging.warning("Incomplete sync from %s not recorded: %s", cb.from_user.id, answers)
+    await reply(cb, ("✅ Синхронизация завершена.\n\nМожно перейти к активностям.", kb_action()))
+    await Flow.action.set()
     await cb.answer()
 
 
-@dp.callback_query_handler(state=Flow.sync_desire)
-async def sync_desire(cb: types.CallbackQuery, state: FSMContext):
-    await notify_admin(cb.from_user.id, "desire", cb.data)
-    await cb.message.edit_text(
-        "🔥 Насколько интенсивно?",
-        reply_markup=kb_sync_intensity()
-    )
-    await Flow.sync_intensity.set()
-    await cb.answer()
+# ================= RUN =================
+async def on_startup(dp: Dispatcher):
+    for task in await activity.root():
+        tag_index.add(task)
+    activity.start()
+    notifier.start()
+    if not SHARDED_WORKER:
+        prune_snapshots()
+    if METRICS_PORT:
+        global metrics_runner
+        metrics_runner = await serve_metrics(registry, profiler, WEBAPP_HOST, int(METRICS_PORT) + SHARD)
+    if BOT_MODE == "webhook" and WEBHOOK_HOST:
+        await bot.set_webhook(WEBHOOK_HOST + WEBHOOK_PATH, drop_pending_updates=True)
 
 
-@dp.callback_query_handler(state=Flow.sync_intensity)
-async def sync_intensity(cb: types.CallbackQuery, state: FSMContext):
-    await notify_admin(cb.from_user.id, "intensity", cb.data)
-    await cb.message.edit_text(
-        "📝 Какое слово сейчас ближе всего?",
-        reply_markup=kb_sync_word()
-    )
-    await Flow.sync_word.set()
-    await cb.answer()
+async def on_shutdown(dp: Dispatcher):
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    await activity.close()
+    await notifier.close()
+    db.close()
 
 
-@dp.callback_query_handler(state=Flow.sync_word)
-async def sync_word(cb: types.CallbackQuery, state: FSMContext):
-    await notify_admin(cb.from_user.id, "word", cb.data)
+async def on_front_startup(app):
+    prune_snapshots()
+    if WEBHOOK_HOST:
+        await bot.set_webhook(WEBHOOK_HOST + WEBHOOK_PATH, drop_pending_updates=True)
 
-    await cb.message.answer(
-        "✅ Синхронизация завершена.\n\nМожно перейти к активностям.",
-        reply_markup=kb_action()
-    )
-    await Flow.action.set()
-    await cb.answer()
 
+async def on_front_shutdown(app):
+    await bot.close()
+    db.close()
 
 
-# ================= RUN =================
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True)
+    if BOT_MODE == "sharded":
+        shards.run_front(
+            os.path.abspath(__file__),
+            SHARDS,
+            user_locks,
+            WEBAPP_HOST,
+            WEBAPP_PORT,
+            WEBHOOK_PATH,
+            on_startup=on_front_startup,
+            on_shutdown=on_front_shutdown,
+            on_reset=reset_front,
+        )
+    elif BOT_MODE == "webhook":
+        executor.start_webhook(
+            dp,
+            WEBHOOK_PATH,
+            on_startup=on_startup,
+            on_shutdown=on_shutdown,
+            host=WEBAPP_HOST,
+            port=WEBAPP_PORT,
+        )
+    else:
+        executor.start_polling(
+            dp,
+            skip_updates=True,
+            on_startup=on_startup,
+            on_shutdown=on_shutdown,
+        )
@@ -0,0 +1,164 @@
+"""
+Sync check-in history: one fixed-width binary record per completed sync,
+appended to a file per user.
+
+A file starts with a 4-byte header (magic, version, number of fields).
+Each record is a little-endian uint32 unix time followed by one byte per
+field: 0 for no answer, otherwise the answer's 1-based position in that
+field's option list. With eight fields a record is 12 bytes, so ten years
+of daily check-ins is about 44 KB.
+"""
+import os
+import struct
+import threading
+import time
+from collections import Counter
+
+import durable
+
+MAGIC = b"CK"
+VERSION = 1
+HEADER = struct.Struct("<2sBB")
+STAMP = struct.Struct("<I")
+DAY = 24 * 60 * 60
+
+
+class CheckinLog:
+    def __init__(self, directory, fields):
+        """
+        fields: [(name, [answer, ...]), ...] in record order. Codes are
+        positions, so new answers and new fields go at the end.
+        """
+        self.directory = directory
+        self.fields = [name for name, _ in fields]
+        self.options = [list(options) for _, options in fields]
+        self._codes = [
+            {answer: i + 1 for i, answer in enumerate(options)}
+            for options in self.options
+        ]
+        self._checked = set()
+        # first appends race on writing the header
+        self._lock = threading.Lock()
+
+    def reopen(self):
+        """Forget the files seen so far: the directory may have been replaced."""
+        self._checked.clear()
+
+    def path(self, uid):
+        return os.path.join(self.directory, f"{uid}.bin")
+
+    # ---------- write ----------
+    def append(self, uid, answers, when=None):
+        """Store one check-in. answers: {field: answer}."""
+        stamp = int(time.time() if when is None else when)
+        record = STAMP.pack(stamp) + bytes(
+            codes.get(answers.get(name), 0)
+            for name, codes in zip(self.fields, self._codes)
+        )
+
+        path = self.path(uid)
+        with self._lock:
+            if path not in self._checked:
+                os.makedirs(self.directory, exist_ok=True)
+                self._upgrade(path)
+                self._checked.add(path)
+            with open(path, "ab") as f:
+                if f.tell() == 0:
+                    record = HEADER.pack(MAGIC, VERSION, len(self.fields)) + record
+                f.write(record)
+
+    def _upgrade(self, path):
+        """Rewrite a file started with fewer fields, padding old records."""
+        if not os.path.exists(path):
+            return
+        count, body = self._read_path(path)
+        if count == len(self.fields):
+            return
+        if count > len(self.fields):
+            raise ValueError(f"{path} has {count} fields, expected {len(self.fields)}")
+        width = STAMP.size + count
+        pad = bytes(len(self.fields) - count)
+        records = b"".join(
+            bytes(body[i:i + width]) + pad for i in range(0, len(body), width)
+        )
+        durable.replace(path, HEADER.pack(MAGIC, VERSION, len(self.fields)) + records)
+
+    # ---------- read ----------
+    def uids(self):
+        """Users with a history, in directory order."""
+        try:
+            entries = os.scandir(self.directory)
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                name = entry.name
+                if name.endswith(".bin") and name[:-4].isdigit():
+                    yield int(name[:-4])
+
+    def _read_path(self, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        if len(data) < HEADER.size:
+            return len(self.fields), memoryview(b"")
+        magic, _, count = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a check-in log")
+        body = memoryview(data)[HEADER.size:]
+        width = STAMP.size + count
+        # drop a torn record at the tail
+        return count, body[:len(body) - len(body) % width]
+
+    def _window(self, uid, days, now):
+        """Records of the last `days` days (all if None) and the field count."""
+        count, body = self._read_path(self.path(uid))
+        width = STAMP.size + count
+        if days is None:
+            return count, body
+
+        # records are appended in time order: binary search the first one in range
+        start = (time.time() if now is None else now) - days * DAY
+        lo, hi = 0, len(body) // width
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if STAMP.unpack_from(body, mid * width)[0] < start:
+                lo = mid + 1
+            else:
+                hi = mid
+        return count, body[lo * width:]
+
+    def count(self, uid, days=None, now=None):
+        count, body = self._window(uid, days, now)
+        return len(body) // (STAMP.size + count)
+
+    def records(self, uid, days=None, now=None):
+        """[(unix time, {field: answer}), ...], oldest first."""
+        count, body = self._window(uid, days, now)
+        layout = struct.Struct(f"<I{count}B")
+        result = []
+        for stamp, *codes in layout.iter_unpack(body):
+            answers = {
+                name: options[code - 1]
+                for name, options, code in zip(self.fields, self.options, codes)
+                if 0 < code <= len(options)
+            }
+            result.append((stamp, answers))
+        return result
+
+    def distribution(self, uid, days=None, now=None):
+        """{field: Counter(answer -> times chosen)} over the window."""
+        count, body = self._window(uid, days, now)
+        width = STAMP.size + count
+        result = {}
+        for i, (name, options) in enumerate(zip(self.fields[:count], self.options)):
+            # every record's byte for this field, as one strided slice
+            column = Counter(body[STAMP.size + i::width])
+            result[name] = Counter({
+                options[code - 1]: n
+                for code, n in column.items()
+                if 0 < code <= len(options)
+            })
+        return result
@@ -0,0 +1,36 @@
+"""
+Crash-safe file writes.
+
+A file is replaced by writing a temp file next to it and renaming that
+over it, so a crash leaves the old content or the new, never a truncated
+or half-written file. Surviving power loss as well takes fsyncs: the temp
+file before the rename, the directory after it.
+"""
+import os
+import threading
+
+
+def _fsync_dir(directory):
+    fd = os.open(directory or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_tmp(path, data, fsync):
+    # unique per thread, so concurrent writers of one path don't collide
+    tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    return tmp
+
+
+def replace(path, data, fsync=True):
+    """Atomically replace `path` with `data` (bytes)."""
+    os.replace(_write_tmp(path, data, fsync), path)
+    if fsync:
+        _fsync_dir(os.path.dirname(path))
@@ -0,0 +1,105 @@
+"""
+Admin export: one zip with users.csv (a row per user) and summary.json
+(most kept and dropped ideas, sync answer totals).
+
+Everything streams. Users come off a cursor one row at a time and go
+straight into the CSV; the tallies are bounded by the number of ideas and
+answers, not users. The database is read on a connection of its own, a
+WAL snapshot, so the export never holds the store's lock; run it off the
+event loop.
+
+The store keeps lists, not events, so "kept" counts ideas that became a
+user's current activity or were completed, and "dropped" counts pool
+ideas a user's list lost without keeping them (discarded or deleted).
+Lists stored in full rather than against the pool have no dropped count.
+"""
+import csv
+import io
+import json
+import sqlite3
+import time
+import zipfile
+from collections import Counter
+
+# removed pool ideas the user did not keep and did not get back
+_DROPPED = """
+    FROM removed r JOIN ideas i ON i.id = r.idea_id
+    WHERE NOT EXISTS (SELECT 1 FROM current c WHERE c.uid = r.uid AND c.text = i.text)
+      AND NOT EXISTS (SELECT 1 FROM completions c WHERE c.uid = r.uid AND c.text = i.text)
+      AND NOT EXISTS (SELECT 1 FROM tasks t WHERE t.uid = r.uid AND t.text = i.text)
+"""
+
+USERS_SQL = f"""
+    SELECT u.uid,
+           (SELECT COUNT(*) FROM completions c WHERE c.uid = u.uid),
+           (SELECT MAX(done_at) FROM completions c WHERE c.uid = u.uid),
+           (SELECT text FROM current c WHERE c.uid = u.uid),
+           (SELECT COUNT(*) {_DROPPED} AND r.uid = u.uid)
+    FROM (SELECT uid FROM seeds UNION SELECT uid FROM tasks UNION SELECT uid FROM current
+          UNION SELECT uid FROM completions UNION SELECT uid FROM prefs) u
+    ORDER BY u.uid
+"""
+
+KEPT_SQL = """
+    SELECT text, COUNT(*) FROM (
+        SELECT text FROM current UNION ALL SELECT text FROM completions
+    ) GROUP BY text ORDER BY 2 DESC, text LIMIT ?
+"""
+
+DROPPED_SQL = f"SELECT i.text, COUNT(*) {_DROPPED} GROUP BY i.text ORDER BY 2 DESC, i.text LIMIT ?"
+
+USER_COLUMNS = ["uid", "completed", "last_completed", "current", "dropped", "syncs"]
+
+
+def _date(stamp):
+    return time.strftime("%Y-%m-%d %H:%M", time.gmtime(stamp)) if stamp else ""
+
+
+def user_rows(conn, checkins):
+    """One row per user with lists or prefs, in uid order."""
+    for uid, completed, last_done, current, dropped in conn.execute(USERS_SQL):
+        yield [uid, completed, _date(last_done), current or "", dropped, checkins.count(uid)]
+
+
+def top_ideas(conn, sql, limit):
+    return [{"idea": text, "times": n} for text, n in conn.execute(sql, (limit,))]
+
+
+def sync_totals(checkins):
+    """{field: {answer: times}} over every history, one file at a time."""
+    totals = {name: Counter() for name in checkins.fields}
+    for uid in checkins.uids():
+        for field, counts in checkins.distribution(uid).items():
+            totals[field].update(counts)
+    return {field: dict(counts.most_common()) for field, counts in totals.items()}
+
+
+def write_export(db_path, checkins, out, top=20):
+    """Write the zip to the binary file `out`; returns the number of users."""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        users = 0
+        with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as archive:
+            with archive.open("users.csv", "w") as raw:
+                text = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+                writer = csv.writer(text)
+                writer.writerow(USER_COLUMNS)
+                for row in user_rows(conn, checkins):
+                    writer.writerow(row)
+                    users += 1
+                text.flush()
+                text.detach()
+
+            summary = {
+                "generated_at": _date(time.time()),
+                "users": users,
+                "completions": conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0],
+                "ideas": conn.execute("SELECT COUNT(*) FROM ideas").fetchone()[0],
+                "most_kept": top_ideas(conn, KEPT_SQL, top),
+                "most_dropped": top_ideas(conn, DROPPED_SQL, top),
+                "sync_answers": sync_totals(checkins),
+            }
+            archive.writestr("summary.json", json.dumps(summary, ensure_ascii=False, indent=1))
+        return users
+    finally:
+        conn.close()
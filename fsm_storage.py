@@ -0,0 +1,257 @@
+import asyncio
+import copy
+import json
+import logging
+import sqlite3
+import typing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from aiogram.dispatcher.storage import BaseStorage
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage in a local SQLite database (WAL mode).
+
+    Records are cached in memory after the first read, so get_state and
+    get_data don't touch the disk; past `capacity` records, the least
+    recently used ones already committed are dropped again. Writes update the cache and are
+    coalesced: everything changed within `flush_delay` seconds is
+    committed in a single transaction. Database work runs on a dedicated
+    worker thread, never on the event loop.
+    """
+
+    EMPTY = {"state": None, "data": {}, "bucket": {}}
+
+    def __init__(self, path, flush_delay=0.2, capacity=4096):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.capacity = capacity
+        self._conn = None
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._flush_handle = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm")
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # ---------- connection ----------
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS fsm ("
+                " chat TEXT NOT NULL,"
+                " user TEXT NOT NULL,"
+                " state TEXT,"
+                " data TEXT NOT NULL,"
+                " bucket TEXT NOT NULL,"
+                " PRIMARY KEY (chat, user))"
+            )
+            self._conn.commit()
+        return self._conn
+
+    async def close(self):
+        await self.flush()
+
+    async def wait_closed(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._cache.clear()
+
+    async def reopen(self, between=None):
+        """
+        Commit, close the database and call `between()` on the storage
+        thread, then start over with an empty cache; the next access
+        opens `path` again.
+        """
+        await self.flush()
+        await self._run(self._reopen, between)
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._cache.clear()
+        self._dirty.clear()
+
+    def _reopen(self, between):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if between is not None:
+            between()
+
+    # ---------- cache ----------
+    async def _record(self, chat, user):
+        key = tuple(map(str, self.check_address(chat=chat, user=user)))
+        record = self._cache.get(key)
+        if record is None:
+            fetched = await self._run(self._fetch, key)
+            record = self._cache.setdefault(key, fetched)
+            self._evict()
+        else:
+            self._cache.move_to_end(key)
+        return key, record
+
+    def _evict(self):
+        excess = len(self._cache) - self.capacity
+        if excess <= 0:
+            return
+        newest = next(reversed(self._cache))
+        victims = []
+        for key in self._cache:
+            if len(victims) == excess or key == newest:
+                break
+            # a dirty record exists nowhere else until the next flush
+            if key not in self._dirty:
+                victims.append(key)
+        for key in victims:
+            del self._cache[key]
+
+    def _fetch(self, key):
+        row = self.conn.execute(
+            "SELECT state, data, bucket FROM fsm WHERE chat = ? AND user = ?", key
+        ).fetchone()
+        if row is None:
+            return copy.deepcopy(self.EMPTY)
+        return {
+            "state": row[0],
+            "data": json.loads(row[1]),
+            "bucket": json.loads(row[2]),
+        }
+
+    def _touch(self, key):
+        self._dirty.add(key)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(
+                self.flush_delay, lambda: asyncio.ensure_future(self.flush())
+            )
+
+    async def flush(self):
+        """
+        Commit every pending change in one transaction. On failure the
+        changes stay pending (and cached) for the next flush.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._dirty:
+            return
+
+        upserts, deletes = [], []
+        for key in self._dirty:
+            record = self._cache[key]
+            if record == self.EMPTY:
+                deletes.append(key)
+            else:
+                upserts.append((
+                    *key,
+                    record["state"],
+                    json.dumps(record["data"], ensure_ascii=False),
+                    json.dumps(record["bucket"], ensure_ascii=False),
+                ))
+        keys, self._dirty = self._dirty, set()
+        try:
+            await self._run(self._commit, upserts, deletes)
+        except sqlite3.Error:
+            logging.exception("Failed to commit %s FSM records", len(keys))
+            self._dirty |= keys
+            self._schedule_flush()
+
+    def _commit(self, upserts, deletes):
+        with self.conn:
+            if upserts:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO fsm (chat, user, state, data, bucket)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    upserts,
+                )
+            if deletes:
+                self.conn.executemany(
+                    "DELETE FROM fsm WHERE chat = ? AND user = ?", deletes
+                )
+
+    # ---------- state / data ----------
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, record = await self._record(chat, user)
+        return record["state"] or self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._record(chat, user)
+        return copy.deepcopy(record["data"])
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key, record = await self._record(chat, user)
+        record["state"] = self.resolve_state(state)
+        self._touch(key)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, record = await self._record(chat, user)
+        record["data"] = copy.deepcopy(data or {})
+        self._touch(key)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key, record = await self._record(chat, user)
+        record["data"].update(data or {}, **kwargs)
+        self._touch(key)
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        key, record = await self._record(chat, user)
+        record["state"] = None
+        if with_data:
+            record["data"] = {}
+        self._touch(key)
+
+    # ---------- bucket ----------
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._record(chat, user)
+        return copy.deepcopy(record["bucket"])
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key, record = await self._record(chat, user)
+        record["bucket"] = copy.deepcopy(bucket or {})
+        self._touch(key)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        key, record = await self._record(chat, user)
+        record["bucket"].update(bucket or {}, **kwargs)
+        self._touch(key)
@@ -0,0 +1,110 @@
+"""
+Duplicate detection for the global idea pool (ROOT_RT).
+
+Ideas are compared by a normalized key (casefolded, ё -> е, punctuation
+and emoji dropped, whitespace collapsed), so "Пойти в кино!" and
+"пойти  в кино" are one idea. Near-duplicates ("правила, героев, поле"
+/ "правила, героев и поле") are caught with a MinHash signature over 4-character shingles, bucketed by LSH bands so a
+lookup only compares against ideas that share a band.
+
+The key and signature are computed once and stored next to the idea.
+"""
+import random
+import struct
+import zlib
+from collections import defaultdict
+
+SHINGLE = 4
+HASHES = 32
+BANDS = 8
+ROWS = HASHES // BANDS
+NEAR = 0.8
+
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 32) - 1
+_rng = random.Random(16)
+_COEFFS = [(_rng.randrange(1, _PRIME), _rng.randrange(_PRIME)) for _ in range(HASHES)]
+_SIG = struct.Struct(f"<{HASHES}I")
+
+
+def normalize(text):
+    text = text.casefold().replace("ё", "е")
+    words = "".join(ch if ch.isalnum() else " " for ch in text).split()
+    # an idea made only of emoji keeps them as its key
+    return " ".join(words) or "".join(text.split())
+
+
+def signature(norm):
+    """MinHash of the key's character shingles, packed into bytes."""
+    if len(norm) <= SHINGLE:
+        shingles = {norm}
+    else:
+        shingles = {norm[i:i + SHINGLE] for i in range(len(norm) - SHINGLE + 1)}
+    hashes = [zlib.crc32(s.encode("utf-8")) for s in shingles]
+    return _SIG.pack(*(
+        min((a * h + b) % _PRIME for h in hashes) & _MASK
+        for a, b in _COEFFS
+    ))
+
+
+def similarity(sig_a, sig_b):
+    """Estimated Jaccard similarity of two signatures."""
+    a, b = _SIG.unpack(sig_a), _SIG.unpack(sig_b)
+    return sum(x == y for x, y in zip(a, b)) / HASHES
+
+
+def fingerprint(text):
+    """(key, signature) of an idea, as stored next to it."""
+    norm = normalize(text)
+    return norm, signature(norm)
+
+
+class IdeaPool:
+    def __init__(self, near=NEAR):
+        self.near = near
+        self.ideas = []
+        self._by_key = {}
+        self._sigs = []
+        self._bands = defaultdict(list)
+
+    def find(self, text, norm=None, sig=None):
+        """The pool's copy of `text` (same key or near-duplicate), or None."""
+        if norm is None:
+            norm = normalize(text)
+        found = self._by_key.get(norm)
+        if found is not None or self.near is None:
+            return found
+
+        if sig is None:
+            sig = signature(norm)
+        for band in self._band_keys(sig):
+            for i in self._bands.get(band, ()):
+                if similarity(sig, self._sigs[i]) >= self.near:
+                    return self.ideas[i]
+        return None
+
+    def add(self, text, norm=None, sig=None):
+        """Add `text` unless the pool has it; return (pool's text, added)."""
+        if norm is None:
+            norm = normalize(text)
+        if sig is None:
+            sig = signature(norm)
+        found = self.find(text, norm, sig)
+        if found is not None:
+            return found, False
+
+        i = len(self.ideas)
+        self.ideas.append(text)
+        self._by_key[norm] = text
+        self._sigs.append(sig)
+        for band in self._band_keys(sig):
+            self._bands[band].append(i)
+        return text, True
+
+    def __len__(self):
+        return len(self.ideas)
+
+    @staticmethod
+    def _band_keys(sig):
+        step = ROWS * 4
+        return [(n, sig[n * step:(n + 1) * step]) for n in range(BANDS)]
@@ -0,0 +1,283 @@
+"""
+Runtime metrics in the Prometheus text format.
+
+A Registry holds counters, latency histograms and gauges (read when
+scraped). MetricsMiddleware times every handler and counts updates by
+callback data and FSM state; `instrument` and `instrument_api` count and
+time calls to the storage backends and the Bot API. `serve` exposes
+GET /metrics, plus GET /profile for the last Profiler report, on a local
+port.
+"""
+import cProfile
+import functools
+import inspect
+import io
+import pstats
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from aiohttp import web
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(name, labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return name
+    return name + "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "n")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.n = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.n += 1
+
+
+class Registry:
+    """Metrics by (name, labels). Safe to update from executor threads."""
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, n=1, **labels):
+        with self._lock:
+            self.counters[name, _labels(labels)] += n
+
+    def observe(self, name, seconds, **labels):
+        with self._lock:
+            self.histograms[name, _labels(labels)].observe(seconds)
+
+    def gauge(self, name, read):
+        """Report read() as `name` on every scrape."""
+        self.gauges[name] = read
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, list(h.counts), h.total, h.n) for key, h in self.histograms.items()
+            )
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{_format(name, labels)} {value}")
+        for (name, labels), counts, total, n in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{_format(name + '_bucket', labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{_format(name + '_sum', labels)} {total:.6f}")
+            lines.append(f"{_format(name + '_count', labels)} {n}")
+        for name, read in sorted(self.gauges.items()):
+            header(name, "gauge")
+            lines.append(f"{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+
+def instrument(registry, obj, names, metric):
+    """
+    Wrap obj.<name> for every name so each call is counted and timed as
+    `metric`{call=name}. Works for plain and async methods.
+    """
+    for name in names:
+        fn = getattr(obj, name)
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, _fn=fn, _name=name, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await _fn(*args, **kwargs)
+                finally:
+                    registry.observe(metric + "_seconds", time.perf_counter() - started, call=_name)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, _fn=fn, _name=name, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return _fn(*args, **kwargs)
+                finally:
+                    registry.observe(metric + "_seconds", time.perf_counter() - started, call=_name)
+        setattr(obj, name, wrapper)
+
+
+def instrument_api(registry, bot):
+    """Count and time Bot API requests by method and outcome."""
+
+    async def counted(method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            # looked up per call, so the class's request can still be swapped
+            return await type(bot).request(bot, method, data, files, **kwargs)
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            registry.observe("telegram_api_seconds", time.perf_counter() - started, method=method)
+            registry.inc("telegram_api_calls_total", method=method, outcome=outcome)
+
+    bot.request = counted
+
+
+class Profiler:
+    """
+    cProfile over the handlers of one user's next `updates` updates.
+
+    The profiler is process-wide, so whatever other tasks run while such a
+    handler awaits is in the report too; it is a sampling aid, not an
+    exact attribution.
+    """
+
+    def __init__(self):
+        self.uid = None
+        self.left = 0
+        self.report = ""
+        self._profile = None
+        self._active = 0
+
+    def start(self, uid, updates=20):
+        self.stop()
+        self.uid = uid
+        self.left = updates
+        self._profile = cProfile.Profile()
+
+    def stop(self, top=30):
+        """End the session and keep its report."""
+        if self._profile is None:
+            return self.report
+        if self._active:
+            self._profile.disable()
+        out = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=out)
+        stats.sort_stats("cumulative").print_stats(top)
+        self.report = f"uid {self.uid}\n{out.getvalue()}"
+        self.uid, self.left, self._profile, self._active = None, 0, None, 0
+        return self.report
+
+    def enter(self, uid):
+        if self._profile is None or uid != self.uid:
+            return False
+        if not self._active:
+            self._profile.enable()
+        self._active += 1
+        return True
+
+    def leave(self):
+        if self._profile is None:
+            # stopped while the handler ran
+            return
+        self._active -= 1
+        if not self._active:
+            self._profile.disable()
+        self.left -= 1
+        if self.left <= 0:
+            self.stop()
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Per-handler latency, update counts by callback data and FSM state, and
+    the Profiler hook. Distinct callback data values are capped so a
+    stream of odd payloads cannot blow up the series count.
+    """
+
+    MAX_CALLBACK_VALUES = 200
+
+    def __init__(self, registry, profiler=None):
+        super().__init__()
+        self.registry = registry
+        self.profiler = profiler
+        self._callback_values = set()
+
+    def _callback_label(self, value):
+        value = (value or "")[:32]
+        if value in self._callback_values:
+            return value
+        if len(self._callback_values) < self.MAX_CALLBACK_VALUES:
+            self._callback_values.add(value)
+            return value
+        return "other"
+
+    async def _process(self, kind, obj, data):
+        handler = current_handler.get()
+        state = data.get("raw_state", "*") or "-"
+        labels = {"kind": kind, "state": state}
+        if kind == "callback_query":
+            labels["data"] = self._callback_label(obj.data)
+        self.registry.inc("updates_total", **labels)
+
+        uid = obj.from_user.id if obj.from_user else None
+        profiled = self.profiler is not None and self.profiler.enter(uid)
+        data["_metrics"] = (getattr(handler, "__name__", "?"), time.perf_counter(), profiled)
+
+    async def _post_process(self, kind, results, data):
+        started = data.pop("_metrics", None)
+        if started is None:
+            self.registry.inc("updates_unhandled_total", kind=kind)
+            return
+        name, stamp, profiled = started
+        self.registry.observe("handler_seconds", time.perf_counter() - stamp, handler=name)
+        if profiled:
+            self.profiler.leave()
+
+    async def on_process_message(self, message, data):
+        await self._process("message", message, data)
+
+    async def on_post_process_message(self, message, results, data):
+        await self._post_process("message", results, data)
+
+    async def on_process_callback_query(self, cb, data):
+        await self._process("callback_query", cb, data)
+
+    async def on_post_process_callback_query(self, cb, results, data):
+        await self._post_process("callback_query", results, data)
+
+
+async def serve(registry, profiler, host, port):
+    """Start the metrics endpoint; returns the runner to clean up."""
+
+    async def metrics(request):
+        return web.Response(text=registry.render(), content_type="text/plain")
+
+    async def profile(request):
+        return web.Response(text=profiler.report or "no report yet\n", content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/profile", profile)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
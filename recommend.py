@@ -0,0 +1,245 @@
+"""
+Sync-aware activity picks.
+
+Every idea gets tags along four axes (duration, energy, social, place)
+plus a couple of flavours. Tags come from keyword rules; tags.txt can
+override them for a given idea. An inverted index maps tag -> idea ids,
+so weighing an idea costs one set lookup per tag the answers care about.
+
+Sampler deals each user's ideas from a shuffled deck, weighted by those
+answers and by what the user kept or threw away before.
+"""
+import random
+import re
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+
+DAY = 24 * 60 * 60
+
+# tag -> keywords (lowercase stems) that imply it
+KEYWORD_RULES = {
+    "short": r"1 час|на один час|ролик|фотобудк|открытк|пофотаться",
+    "long": r"день|месяц|марафон|квест|воркшоп|\bархив",
+    "calm": r"посмотреть|плейлист|библиотек|выставк|музей|лекци|кафе|обед",
+    "active": r"танец|жонглир|охот|квест|марафон|найти",
+    "pair": r"пар[ыа]|вдвоём|для двоих|ваш|партнер|каждый",
+    "crowd": r"концерт|лекци|воркшоп|ted|поэтическ|мастерск",
+    "home": r"дом[уа]?\b|плейлист|настольн|открытк|ролик|капсул|интерьер",
+    "out": r"сходить|пойти|посетить|побывать|зайти|кафе|парк|музей|выставк|город|библиотек|смотров|фотобудк|мастерск|предприятие питан",
+    "create": r"собрать|сделать|придумать|смешать|распечатать|каллиграф",
+    "learn": r"учимся|навык|лекци|хобби|архив|музей",
+}
+_RULES = [(tag, re.compile(pattern)) for tag, pattern in KEYWORD_RULES.items()]
+
+# sync answer -> ({tag: weight to prefer}, {tags to leave out})
+ANSWER_TAGS = {
+    "energy_zero": ({"calm": 3, "home": 1}, {"active"}),
+    "energy_calm": ({"calm": 2}, set()),
+    "energy_charged": ({"active": 2}, set()),
+    "energy_over": ({"active": 3, "out": 1}, {"calm"}),
+    "weather_cloud": ({"home": 1, "calm": 1}, set()),
+    "weather_rain": ({"home": 2, "calm": 2}, {"crowd"}),
+    "weather_clear": ({"out": 1}, set()),
+    "weather_sun": ({"out": 2, "active": 1}, set()),
+    "social_no": ({"pair": 2, "home": 1}, {"crowd"}),
+    "social_one": ({"pair": 2}, set()),
+    "social_all": ({"crowd": 3, "out": 1}, set()),
+    "focus_mind": ({"learn": 2}, set()),
+    "focus_heart": ({"pair": 2}, set()),
+    "focus_body": ({"active": 2}, set()),
+    "time_1h": ({"short": 3}, {"long"}),
+    "time_2h": ({"short": 1}, {"long"}),
+    "time_3_4h": ({"long": 2}, set()),
+    "desire_relax": ({"calm": 2}, set()),
+    "desire_reset": ({"out": 2, "active": 1}, set()),
+    "desire_create": ({"create": 3}, set()),
+    "desire_useful": ({"learn": 3}, set()),
+    "intensity_soft": ({"calm": 2}, set()),
+    "intensity_hard": ({"active": 2}, set()),
+}
+
+
+def infer_tags(text):
+    lowered = text.lower()
+    return frozenset(tag for tag, rule in _RULES if rule.search(lowered))
+
+
+def load_overrides(path):
+    """tags.txt lines: `tag tag ... | idea text`. Missing file means none."""
+    overrides = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if "|" not in line or line.lstrip().startswith("#"):
+                    continue
+                tags, text = line.split("|", 1)
+                overrides[text.strip()] = frozenset(tags.split())
+    except FileNotFoundError:
+        pass
+    return overrides
+
+
+class TagIndex:
+    def __init__(self, overrides=None):
+        self.overrides = overrides or {}
+        self.ids = {}
+        self.tags = []
+        self.by_tag = defaultdict(set)
+
+    def add(self, text):
+        """Index an idea (once) and return its id."""
+        idea_id = self.ids.get(text)
+        if idea_id is None:
+            idea_id = self.ids[text] = len(self.tags)
+            tags = self.overrides.get(text.strip())
+            if tags is None:
+                tags = infer_tags(text)
+            self.tags.append(tags)
+            for tag in tags:
+                self.by_tag[tag].add(idea_id)
+        return idea_id
+
+    def weight(self, idea_id, prefer, avoid):
+        """0 if the idea has an avoided tag, else 1 plus its preferred tags' weights."""
+        if any(idea_id in self.by_tag[tag] for tag in avoid):
+            return 0
+        return 1 + sum(w for tag, w in prefer.items() if idea_id in self.by_tag[tag])
+
+
+def answer_tags(answers):
+    """Merge sync answers into ({tag: weight to prefer}, {tags to leave out})."""
+    prefer, avoid = defaultdict(int), set()
+    for answer in answers or ():
+        weights, excluded = ANSWER_TAGS.get(answer, ({}, ()))
+        for tag, weight in weights.items():
+            prefer[tag] += weight
+        avoid.update(excluded)
+    return prefer, avoid
+
+
+def _fingerprint(task):
+    return zlib.crc32(task.encode("utf-8"))
+
+
+class _Deck:
+    __slots__ = ("user", "grown", "order", "pos")
+
+    def __init__(self, user, order, pos):
+        self.user = user
+        self.grown = user.grown
+        self.order = order
+        self.pos = pos
+
+
+class Sampler:
+    """
+    Per-user draws without repeats.
+
+    Each user has a deck of their ideas; the part after `pos` is not dealt
+    yet. A draw picks a random card from that part and deals it (swaps it
+    to `pos`) with probability weight / max weight, so every idea is shown
+    once before any comes back. Cards no longer on the list, or ruled out
+    by the answers, are dealt away silently. The weight is the sync-answer weight times a learned factor
+    (1/4 to 4) from the tags of ideas the user kept, completed, changed or
+    discarded; those scores halve every `half_life` seconds.
+
+    A draw is expected O(1); the deck is rebuilt (O(n)) only when tasks
+    join the list. The affinities and the ideas already shown this round
+    live in user.prefs, so the store persists them.
+    """
+
+    EVENTS = {"keep": 0.5, "complete": 1.0, "change": -0.25, "discard": -1.0}
+    MAX_SHIFT = 2
+
+    def __init__(self, index, half_life=14 * DAY, capacity=1024, rng=random, clock=time.time):
+        self.index = index
+        self.half_life = half_life
+        self.capacity = capacity
+        self.rng = rng
+        self.clock = clock
+        self._decks = OrderedDict()
+
+    # ---------- learning ----------
+    def learn(self, user, event, task):
+        if task is None:
+            return
+        now = self.clock()
+        affinity = user.prefs.setdefault("affinity", {})
+        for tag in self.index.tags[self.index.add(task)]:
+            score, stamp = affinity.get(tag, (0.0, now))
+            affinity[tag] = [round(self._decay(score, stamp, now) + self.EVENTS[event], 3), int(now)]
+        user.touch_prefs()
+
+    def _decay(self, score, stamp, now):
+        return score * 0.5 ** (max(0, now - stamp) / self.half_life)
+
+    def _shift(self, tags, learned):
+        shift = sum(learned.get(tag, 0) for tag in tags)
+        return max(-self.MAX_SHIFT, min(self.MAX_SHIFT, shift))
+
+    # ---------- drawing ----------
+    def _deck(self, user):
+        deck = self._decks.get(user.uid)
+        if deck is not None and deck.user is user and deck.grown == user.grown:
+            self._decks.move_to_end(user.uid)
+            return deck
+
+        # this round's already-shown ideas go in front, as dealt
+        shown_ids = set(user.prefs.get("shown", ()))
+        unique = list(dict.fromkeys(user.rt))
+        shown = [task for task in unique if _fingerprint(task) in shown_ids]
+        fresh = [task for task in unique if _fingerprint(task) not in shown_ids]
+        deck = self._decks[user.uid] = _Deck(user, shown + fresh, len(shown))
+        while len(self._decks) > self.capacity:
+            self._decks.popitem(last=False)
+        return deck
+
+    def _deal(self, deck, i):
+        order, pos = deck.order, deck.pos
+        order[pos], order[i] = order[i], order[pos]
+        deck.pos += 1
+        return order[pos]
+
+    def draw(self, user, answers=()):
+        """Next idea for `user` from user.rt, or None if it is empty."""
+        if not user.rt:
+            return None
+        deck = self._deck(user)
+        prefer, avoid = answer_tags(answers)
+        now = self.clock()
+        learned = {
+            tag: self._decay(score, stamp, now)
+            for tag, (score, stamp) in user.prefs.get("affinity", {}).items()
+        }
+        boost = min(self.MAX_SHIFT, sum(score for score in learned.values() if score > 0))
+        top = (1 + sum(prefer.values())) * 2 ** boost
+        shown = user.prefs.setdefault("shown", [])
+
+        task = None
+        for _ in range(4 * len(deck.order) + 8):
+            if deck.pos >= len(deck.order):
+                deck.pos = 0
+                shown.clear()
+            i = self.rng.randrange(deck.pos, len(deck.order))
+            candidate = deck.order[i]
+            if not user.has(candidate):
+                self._deal(deck, i)
+                continue
+            idea_id = self.index.add(candidate)
+            weight = self.index.weight(idea_id, prefer, avoid)
+            if weight == 0:
+                # ruled out by the answers: sit this round out
+                self._deal(deck, i)
+                continue
+            weight *= 2 ** self._shift(self.index.tags[idea_id], learned)
+            if self.rng.random() * top < weight:
+                task = self._deal(deck, i)
+                break
+        if task is None:
+            # everything left is ruled out by the answers
+            task = self.rng.choice(user.rt)
+
+        shown.append(_fingerprint(task))
+        user.touch_prefs()
+        return task
@@ -0,0 +1,184 @@
+"""
+Sharded webhook deployment.
+
+A front process takes the webhook and forwards every update to one of N
+worker processes, picked by user id, so a user is always served by the
+same worker and the workers can use a core each. Workers are bot.py in
+webhook mode on WEBAPP_PORT+1 ... WEBAPP_PORT+N.
+
+The front holds at most one update per user in flight and returns the
+worker's response to Telegram, so a user's updates reach their worker in
+order. Each worker keeps its FSM state in a file of its own; the activity
+database is shared, its rows are per user, and the idea pool is picked up
+from it by every worker.
+
+A worker sends SIGUSR1 to the front to have the data reset: the front
+stops every worker, so nothing has the data dir open, runs its reset and
+starts them again. Updates arriving meanwhile wait for their worker.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+
+from aiohttp import ClientConnectionError, ClientSession, ClientTimeout, web
+
+
+def update_user(update):
+    """Id of the user an Update (as JSON) comes from, or None."""
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"].get("id")
+    return None
+
+
+def shard_for(uid, shards):
+    return uid % shards if uid is not None else 0
+
+
+class Workers:
+    """bot.py processes serving one shard each, restarted if they exit."""
+
+    def __init__(self, script, shards, host, base_port, path):
+        self.script = script
+        self.shards = shards
+        self.host = host
+        self.ports = [base_port + 1 + i for i in range(shards)]
+        self.urls = [f"http://{host}:{port}{path}" for port in self.ports]
+        self.procs = [None] * shards
+        self.restarting = False
+
+    def spawn(self, i):
+        env = dict(
+            os.environ,
+            BOT_MODE="webhook",
+            WEBHOOK_HOST="",  # the front owns the webhook
+            WEBAPP_HOST=self.host,
+            WEBAPP_PORT=str(self.ports[i]),
+            SHARD=str(i),
+            SHARDS=str(self.shards),
+        )
+        self.procs[i] = subprocess.Popen([sys.executable, self.script], env=env)
+        logging.info("shard %s: pid %s on port %s", i, self.procs[i].pid, self.ports[i])
+
+    def start(self):
+        for i in range(self.shards):
+            self.spawn(i)
+
+    def revive(self, i):
+        """Restart worker `i` if it is gone; True if it had to be."""
+        proc = self.procs[i]
+        if self.restarting:
+            return False
+        if proc is None or proc.poll() is not None:
+            logging.warning("shard %s exited (%s), restarting", i, proc and proc.returncode)
+            self.spawn(i)
+            return True
+        return False
+
+    def stop(self, timeout=10):
+        for proc in self.procs:
+            if proc and proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+        for proc in self.procs:
+            if proc is None:
+                continue
+            try:
+                proc.wait(timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    def restart(self, between=None):
+        """Stop every worker, call between() and start them again; blocking."""
+        self.restarting = True
+        try:
+            self.stop()
+            if between is not None:
+                between()
+        finally:
+            self.start()
+            self.restarting = False
+
+
+class ShardRouter:
+    """aiohttp handler forwarding updates to the worker of their user."""
+
+    def __init__(self, workers, locks, retries=40, retry_delay=0.25):
+        self.workers = workers
+        self.locks = locks
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.session = None
+
+    async def start(self, app):
+        self.session = ClientSession(timeout=ClientTimeout(total=65))
+
+    async def close(self, app):
+        await self.session.close()
+
+    async def handle(self, request):
+        body = await request.read()
+        uid = update_user(json.loads(body))
+        i = shard_for(uid, self.workers.shards)
+        if uid is None:
+            return await self._forward(i, body)
+        async with self.locks(uid):
+            return await self._forward(i, body)
+
+    async def _forward(self, i, body):
+        headers = {"Content-Type": "application/json"}
+        for _ in range(self.retries):
+            try:
+                async with self.session.post(self.workers.urls[i], data=body, headers=headers) as resp:
+                    # the worker may answer with a Bot API call in the body
+                    return web.Response(
+                        body=await resp.read(),
+                        status=resp.status,
+                        content_type=resp.content_type,
+                    )
+            except ClientConnectionError:
+                # starting up, or died: give it a moment
+                self.workers.revive(i)
+                await asyncio.sleep(self.retry_delay)
+        logging.error("shard %s unreachable, update dropped", i)
+        return web.Response(status=503)
+
+
+def run_front(script, shards, locks, host, port, path, on_startup=None, on_shutdown=None,
+              on_reset=None):
+    """
+    Start the workers and serve the front webhook until interrupted.
+    on_reset (blocking) runs with every worker stopped on SIGUSR1.
+    """
+    workers = Workers(script, shards, "127.0.0.1", port, path)
+    router = ShardRouter(workers, locks)
+
+    async def reset():
+        if workers.restarting:
+            return
+        logging.warning("data reset: restarting %s workers", shards)
+        await asyncio.get_running_loop().run_in_executor(None, workers.restart, on_reset)
+
+    async def listen(app):
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR1, lambda: asyncio.ensure_future(reset())
+        )
+
+    app = web.Application()
+    app.router.add_post(path, router.handle)
+    app.on_startup.append(router.start)
+    app.on_startup.append(listen)
+    app.on_cleanup.append(router.close)
+    if on_startup:
+        app.on_startup.append(on_startup)
+    if on_shutdown:
+        app.on_cleanup.append(on_shutdown)
+
+    workers.start()
+    try:
+        web.run_app(app, host=host, port=port)
+    finally:
+        workers.stop()
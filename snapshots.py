@@ -0,0 +1,105 @@
+"""
+Data dir snapshots: resetting the bot's data without deleting it.
+
+`swap` renames the data dir into the snapshot dir under a timestamp and
+creates an empty one in its place, two directory operations however many
+users there are. Both dirs must be on one filesystem, and whatever holds
+files in the data dir open (the databases) has to close them first.
+
+`prune` deletes snapshots past the retention limits, moving each out of
+the way before removing it so a half-deleted one never looks like a
+snapshot; `prune_in_background` runs it on a thread of its own. To undo a
+reset, stop the bot and move a snapshot back in place of the data dir.
+"""
+import logging
+import os
+import shutil
+import threading
+import time
+
+STAMP = "%Y%m%d-%H%M%S"
+DAY = 24 * 60 * 60
+TRASH = ".deleting-"
+
+_pruning = threading.Lock()
+
+
+def snapshot_path(snapshot_dir, now=None):
+    """An unused path in `snapshot_dir` for a snapshot taken now."""
+    name = time.strftime(STAMP, time.localtime(now))
+    path = os.path.join(snapshot_dir, name)
+    n = 1
+    while os.path.exists(path):
+        path = os.path.join(snapshot_dir, f"{name}-{n}")
+        n += 1
+    return path
+
+
+def swap(data_dir, path):
+    """
+    Move `data_dir` to `path` and leave an empty `data_dir`. On failure
+    `data_dir` is left where it was.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.rename(data_dir, path)
+    try:
+        os.makedirs(data_dir)
+    except OSError:
+        os.rename(path, data_dir)
+        raise
+
+
+def snapshots(snapshot_dir):
+    """[(taken at, path)] newest first."""
+    found = []
+    try:
+        names = os.listdir(snapshot_dir)
+    except FileNotFoundError:
+        return found
+    for name in names:
+        try:
+            taken = time.mktime(time.strptime(name[:15], STAMP))
+        except ValueError:
+            continue
+        found.append((taken, os.path.join(snapshot_dir, name)))
+    found.sort(reverse=True)
+    return found
+
+
+def prune(snapshot_dir, keep=5, max_age=30 * DAY, now=None):
+    """
+    Delete every snapshot but the newest `keep`, and any older than
+    `max_age` seconds. Returns how many were deleted.
+    """
+    now = time.time() if now is None else now
+    with _pruning:
+        for i, (taken, path) in enumerate(snapshots(snapshot_dir)):
+            if i >= keep or now - taken > max_age:
+                os.rename(path, os.path.join(snapshot_dir, TRASH + os.path.basename(path)))
+
+        deleted = 0
+        for name in os.listdir(snapshot_dir) if os.path.isdir(snapshot_dir) else ():
+            # including leftovers of a prune that was interrupted
+            if name.startswith(TRASH):
+                shutil.rmtree(os.path.join(snapshot_dir, name))
+                deleted += 1
+        return deleted
+
+
+def _prune_logged(snapshot_dir, keep, max_age):
+    started = time.monotonic()
+    try:
+        deleted = prune(snapshot_dir, keep, max_age)
+    except OSError:
+        logging.exception("Failed to prune snapshots in %s", snapshot_dir)
+        return
+    if deleted:
+        logging.info("Deleted %s snapshots in %.1fs", deleted, time.monotonic() - started)
+
+
+def prune_in_background(snapshot_dir, keep=5, max_age=30 * DAY):
+    thread = threading.Thread(
+        target=_prune_logged, args=(snapshot_dir, keep, max_age), name="snapshots", daemon=True
+    )
+    thread.start()
+    return thread
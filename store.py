@@ -0,0 +1,732 @@
+import asyncio
+import glob
+import itertools
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from ideas import IdeaPool, fingerprint
+
+
+# ================= FILE HELPERS =================
+def read_lines(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [l.strip() for l in f if l.strip()]
+
+
+# ================= USER DATA =================
+# Versions are unique across every UserData of the process, so a user
+# reloaded after eviction never reuses a version of the copy it replaced.
+_versions = itertools.count(1)
+
+class UserData:
+    """
+    Activity lists of one user: rt (pool), p (current), c (completed).
+
+    Every mutation is also recorded in `ops` as (op, index, task) so the
+    store can append it to the user's journal instead of rewriting files.
+    `prefs` is a small JSON-able dict saved alongside the lists; call
+    touch_prefs() after changing it.
+    """
+
+    __slots__ = ("uid", "rt", "p", "c", "ops", "full", "prefs", "prefs_dirty",
+                 "grown", "version", "_count")
+
+    def __init__(self, uid, rt, p, c, prefs=None):
+        self.uid = uid
+        self.rt = rt
+        self.p = p
+        self.c = c
+        self.ops = []
+        self.full = False
+        self.prefs = prefs or {}
+        self.prefs_dirty = False
+        # grown is bumped whenever a task joins rt, version renewed on any
+        # change to it; _count answers has() in O(1)
+        self.grown = 0
+        self.version = next(_versions)
+        self._count = Counter(rt)
+
+    @property
+    def current(self):
+        return self.p[0] if self.p else None
+
+    @property
+    def dirty(self):
+        return self.full or self.prefs_dirty or bool(self.ops)
+
+    def has(self, task):
+        return self._count[task] > 0
+
+    def touch_prefs(self):
+        self.prefs_dirty = True
+
+    def take_changes(self):
+        """
+        Hand pending changes over for writing as (uid, ops, snapshot, prefs).
+        `snapshot` copies rt/p/c when the whole user must be rewritten,
+        `prefs` is the serialized prefs if they changed.
+        """
+        snapshot = (self.rt[:], self.p[:], self.c[:]) if self.full else None
+        prefs = json.dumps(self.prefs, ensure_ascii=False) if self.prefs_dirty else None
+        changes = (self.uid, self.ops, snapshot, prefs)
+        self.ops = []
+        self.full = False
+        self.prefs_dirty = False
+        return changes
+
+    def restore_changes(self, changes):
+        """Put back changes whose write failed, ahead of any newer ops."""
+        _, ops, snapshot, prefs = changes
+        self.ops[:0] = ops
+        self.full = self.full or snapshot is not None
+        self.prefs_dirty = self.prefs_dirty or prefs is not None
+
+    def reseed(self, tasks):
+        """Refill rt wholesale; the next save rewrites the user."""
+        self.rt.extend(tasks)
+        self._count.update(tasks)
+        self.grown += 1
+        self.version = next(_versions)
+        self.full = True
+
+    def apply(self, op, index, task):
+        if op == "add":
+            self._push(task)
+        elif op == "remove":
+            self._drop(index, task)
+        elif op == "pick":
+            self._drop(index, task)
+            self.p[:] = [task]
+        elif op == "complete":
+            self.c.append(task)
+            self.p.clear()
+        elif op == "change":
+            self._push(task)
+            self.p.clear()
+        else:
+            raise ValueError(f"Unknown journal op: {op}")
+
+    def _push(self, task):
+        self.rt.append(task)
+        self._count[task] += 1
+        self.grown += 1
+        self.version = next(_versions)
+
+    def _drop(self, index, task):
+        if index is not None and index < len(self.rt) and self.rt[index] == task:
+            del self.rt[index]
+        elif self.has(task):
+            self.rt.remove(task)
+        else:
+            return
+        self._count[task] -= 1
+        self.version = next(_versions)
+
+    def _record(self, op, index, task):
+        self.apply(op, index, task)
+        self.ops.append((op, index, task))
+
+    def add(self, task):
+        self._record("add", None, task)
+
+    def remove(self, task):
+        if task in self.rt:
+            self._record("remove", self.rt.index(task), task)
+
+    def remove_at(self, indices):
+        """Pop tasks by index, highest index first, and return them."""
+        removed = []
+        for i in sorted(indices, reverse=True):
+            task = self.rt[i]
+            self._record("remove", i, task)
+            removed.append(task)
+        return removed
+
+    def pick(self, task, index=None):
+        if index is None and task in self.rt:
+            index = self.rt.index(task)
+        self._record("pick", index, task)
+
+    def complete(self):
+        task = self.current
+        if task is not None:
+            self._record("complete", None, task)
+        return task
+
+    def change(self):
+        task = self.current
+        if task is not None:
+            self._record("change", None, task)
+        return task
+
+
+# ================= FILE BACKEND =================
+class FileBackend:
+    """
+    The activity lists as the bot kept them before the database: rt/p/c
+    snapshots plus a JSON-lines journal of ops per user. Only read now,
+    for SQLiteBackend's one-time import.
+    """
+
+    def __init__(self, files_for):
+        self.files_for = files_for
+
+    def load(self, uid):
+        files = self.files_for(uid)
+        user = UserData(
+            uid,
+            read_lines(files["rt"]),
+            read_lines(files["p"]),
+            read_lines(files["c"]),
+            self._read_prefs(files),
+        )
+        journal = read_lines(files["j"])
+        for n, line in enumerate(journal):
+            try:
+                op = json.loads(line)
+            except ValueError:
+                if n < len(journal) - 1:
+                    raise
+                # torn by a crash mid-append
+                logging.warning("Skipping a torn journal line for %s", uid)
+                break
+            user.apply(*op)
+        return user
+
+    def _read_prefs(self, files):
+        try:
+            with open(files["s"], encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+
+# ================= SQLITE BACKEND =================
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ideas (
+    id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL,
+    norm TEXT,
+    sig BLOB
+);
+CREATE INDEX IF NOT EXISTS ideas_text ON ideas (text);
+CREATE TABLE IF NOT EXISTS seeds (
+    uid INTEGER PRIMARY KEY,
+    upto INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS removed (
+    uid INTEGER NOT NULL,
+    idea_id INTEGER NOT NULL,
+    PRIMARY KEY (uid, idea_id)
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    uid INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_uid ON tasks (uid, id);
+CREATE TABLE IF NOT EXISTS current (
+    uid INTEGER PRIMARY KEY,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS completions (
+    id INTEGER PRIMARY KEY,
+    uid INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    done_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS completions_uid ON completions (uid, id);
+CREATE TABLE IF NOT EXISTS prefs (
+    uid INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
+USER_FILE_RE = re.compile(r"^(\d+)(rt|p|c)\.txt$")
+
+
+class SQLiteBackend:
+    """
+    Activity lists in one SQLite database: `ideas` is the global pool
+    (ROOT_RT), `current` and `completions` hold each user's p and c lists,
+    `prefs` their prefs as JSON.
+
+    A user's rt is stored copy-on-write: `seeds.upto` points at the pool
+    as it was (every idea with id <= upto), `removed` lists the pool ideas
+    the user no longer has and `tasks` the ones they added. Seeding a new
+    user writes one row instead of a copy of the pool.
+
+    On first open the existing text files under `data_dir` are imported
+    once; after that only the database is used. The connection may be used
+    from worker threads; `lock` serializes access to it.
+    """
+
+    def __init__(self, path, data_dir, root_path, files_for):
+        self.path = path
+        self.data_dir = data_dir
+        self.root_path = root_path
+        self.files_for = files_for
+        self.lock = threading.RLock()
+        self._open()
+
+    def _open(self, ideas_from=None):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        if ideas_from is not None:
+            self.copy_ideas(ideas_from)
+        self.import_files()
+        self.index_ideas()
+        self.seed_lists()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def reopen(self, between=None, ideas_from=None):
+        """
+        Close the database, call `between()` and open `path` again, e.g.
+        after the data dir was swapped for an empty one. With `ideas_from`
+        (the path of an older database) a new database starts with that
+        idea pool instead of importing rt.txt. If `between()` fails, the
+        database at `path` is reopened as it was and the error re-raised.
+        """
+        with self.lock:
+            self.conn.close()
+            try:
+                if between is not None:
+                    between()
+            except BaseException:
+                self._open()
+                raise
+            self._open(ideas_from)
+
+    # ---------- import ----------
+    def import_files(self):
+        """Copy the legacy rt.txt and data/*.txt lists into the database once."""
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'imported'").fetchone():
+            return
+
+        files = FileBackend(self.files_for)
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO ideas (text) VALUES (?)",
+                ((task,) for task in read_lines(self.root_path)),
+            )
+            count = 0
+            for path in glob.glob(os.path.join(self.data_dir, "*rt.txt")):
+                match = USER_FILE_RE.match(os.path.basename(path))
+                if match is None:
+                    continue
+                user = files.load(int(match.group(1)))
+                self._replace(user.uid, (user.rt, user.p, user.c))
+                if user.prefs:
+                    self._write_prefs(user.uid, json.dumps(user.prefs, ensure_ascii=False))
+                count += 1
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('imported', ?)",
+                              (str(int(time.time())),))
+        logging.info("Imported %s users from %s", count, self.data_dir)
+
+    def copy_ideas(self, path):
+        """Fill an empty pool from the database at `path`; no import after that."""
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'imported'").fetchone():
+            return
+        self.conn.execute("ATTACH DATABASE ? AS old", (path,))
+        try:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO ideas (id, text, norm, sig) SELECT id, text, norm, sig FROM old.ideas")
+                self.conn.execute("INSERT INTO meta (key, value) VALUES ('imported', ?)",
+                                  (str(int(time.time())),))
+        finally:
+            self.conn.execute("DETACH DATABASE old")
+
+    # ---------- root pool ----------
+    def index_ideas(self):
+        """Store the dedup key and signature of ideas that lack them."""
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(ideas)")}
+        with self.conn:
+            if "norm" not in columns:
+                self.conn.execute("ALTER TABLE ideas ADD COLUMN norm TEXT")
+                self.conn.execute("ALTER TABLE ideas ADD COLUMN sig BLOB")
+            rows = self.conn.execute("SELECT id, text FROM ideas WHERE norm IS NULL").fetchall()
+            self.conn.executemany(
+                "UPDATE ideas SET norm = ?, sig = ? WHERE id = ?",
+                ((*fingerprint(text), idea_id) for idea_id, text in rows),
+            )
+
+    def seed_lists(self):
+        """Rewrite lists stored as full copies relative to the pool, once."""
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'seeded'").fetchone():
+            return
+        with self.conn:
+            uids = [row[0] for row in self.conn.execute(
+                "SELECT DISTINCT uid FROM tasks WHERE uid NOT IN (SELECT uid FROM seeds)")]
+            for uid in uids:
+                self._write_rt(uid, self._read_rt(uid))
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('seeded', ?)",
+                              (str(int(time.time())),))
+        if uids:
+            logging.info("Stored %s lists relative to the idea pool", len(uids))
+
+    def load_root(self, skip=0):
+        """[(text, key, signature)] in pool order, after the first `skip`."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT text, norm, sig FROM ideas ORDER BY id LIMIT -1 OFFSET ?", (skip,)
+            ).fetchall()
+
+    def add_root(self, task, norm=None, sig=None):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO ideas (text, norm, sig) VALUES (?, ?, ?)",
+                              (task, norm, sig))
+
+    # ---------- users ----------
+    def load(self, uid):
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM prefs WHERE uid = ?", (uid,)).fetchone()
+            return UserData(
+                uid,
+                self.read("rt", uid),
+                self.read("p", uid),
+                self.read("c", uid),
+                json.loads(row[0]) if row else None,
+            )
+
+    def save(self, changes):
+        with self.lock, self.conn:
+            for uid, ops, snapshot, prefs in changes:
+                if prefs is not None:
+                    self._write_prefs(uid, prefs)
+                if snapshot is not None:
+                    self._replace(uid, snapshot)
+                else:
+                    for op in ops:
+                        self._apply(uid, *op)
+
+    def _apply(self, uid, op, index, task):
+        if op in ("add", "change"):
+            self.conn.execute("INSERT INTO tasks (uid, text) VALUES (?, ?)", (uid, task))
+        if op in ("remove", "pick"):
+            self._drop(uid, index, task)
+        if op == "pick":
+            self.conn.execute("INSERT OR REPLACE INTO current (uid, text) VALUES (?, ?)",
+                              (uid, task))
+        if op == "complete":
+            self.conn.execute(
+                "INSERT INTO completions (uid, text, done_at) VALUES (?, ?, ?)",
+                (uid, task, int(time.time())),
+            )
+        if op in ("complete", "change"):
+            self.conn.execute("DELETE FROM current WHERE uid = ?", (uid,))
+
+    def _drop(self, uid, index, task):
+        # rt lists the seeded pool ideas first, so a task that is one of
+        # them is taken from there, like list.remove would
+        row = self.conn.execute(
+            "SELECT i.id FROM ideas i JOIN seeds s ON s.uid = ?"
+            " WHERE i.text = ? AND i.id <= s.upto"
+            " AND i.id NOT IN (SELECT idea_id FROM removed WHERE uid = ?)"
+            " ORDER BY i.id LIMIT 1",
+            (uid, task, uid),
+        ).fetchone()
+        if row is not None:
+            self.conn.execute("INSERT INTO removed (uid, idea_id) VALUES (?, ?)", (uid, row[0]))
+            return
+        self.conn.execute(
+            "DELETE FROM tasks WHERE id = ("
+            " SELECT id FROM tasks WHERE uid = ? AND text = ? ORDER BY id LIMIT 1)",
+            (uid, task),
+        )
+
+    def _read_rt(self, uid):
+        seeded = self.conn.execute(
+            "SELECT i.text FROM ideas i JOIN seeds s ON s.uid = ?"
+            " WHERE i.id <= s.upto"
+            " AND i.id NOT IN (SELECT idea_id FROM removed WHERE uid = ?)"
+            " ORDER BY i.id",
+            (uid, uid),
+        )
+        added = self.conn.execute("SELECT text FROM tasks WHERE uid = ? ORDER BY id", (uid,))
+        return [row[0] for row in seeded] + [row[0] for row in added]
+
+    def _write_rt(self, uid, lines):
+        """Store `lines` as the latest pool minus what is missing plus extras."""
+        for table in ("seeds", "removed", "tasks"):
+            self.conn.execute(f"DELETE FROM {table} WHERE uid = ?", (uid,))
+        if not lines:
+            return
+
+        upto = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM ideas").fetchone()[0]
+        wanted = Counter(lines)
+        removed = []
+        for idea_id, text in self.conn.execute("SELECT id, text FROM ideas ORDER BY id"):
+            if wanted[text] > 0:
+                wanted[text] -= 1
+            else:
+                removed.append(idea_id)
+        extra = []
+        for line in lines:
+            if wanted[line] > 0:
+                wanted[line] -= 1
+                extra.append(line)
+
+        # a list that kept little of the pool is cheaper stored in full
+        if len(removed) > len(lines):
+            upto, removed, extra = 0, [], lines
+        if upto:
+            self.conn.execute("INSERT INTO seeds (uid, upto) VALUES (?, ?)", (uid, upto))
+            self.conn.executemany("INSERT INTO removed (uid, idea_id) VALUES (?, ?)",
+                                  ((uid, idea_id) for idea_id in removed))
+        self.conn.executemany("INSERT INTO tasks (uid, text) VALUES (?, ?)",
+                              ((uid, line) for line in extra))
+
+    def _write_prefs(self, uid, prefs):
+        self.conn.execute("INSERT OR REPLACE INTO prefs (uid, data) VALUES (?, ?)", (uid, prefs))
+
+    def _replace(self, uid, snapshot):
+        for key, lines in zip(("rt", "p", "c"), snapshot):
+            self._write(key, uid, lines)
+
+    def reset(self):
+        """Forget every user's lists; the idea pool stays."""
+        with self.lock, self.conn:
+            for table in ("seeds", "removed", "tasks", "current", "completions", "prefs"):
+                self.conn.execute(f"DELETE FROM {table}")
+
+    # ---------- line access ----------
+    def read(self, kind, uid):
+        with self.lock:
+            return self._read(kind, uid)
+
+    def _read(self, kind, uid):
+        if kind == "rt":
+            return self._read_rt(uid)
+        elif kind == "p":
+            rows = self.conn.execute("SELECT text FROM current WHERE uid = ?", (uid,))
+        else:
+            rows = self.conn.execute(
+                "SELECT text FROM completions WHERE uid = ? ORDER BY id", (uid,)
+            )
+        return [row[0] for row in rows]
+
+    def _write(self, kind, uid, lines):
+        if kind == "rt":
+            self._write_rt(uid, lines)
+            return
+        if kind == "p":
+            self.conn.execute("DELETE FROM current WHERE uid = ?", (uid,))
+        else:
+            self.conn.execute("DELETE FROM completions WHERE uid = ?", (uid,))
+        for line in lines:
+            self._insert(kind, uid, line)
+
+    def _insert(self, kind, uid, line):
+        if kind == "p":
+            self.conn.execute("INSERT OR REPLACE INTO current (uid, text) VALUES (?, ?)",
+                              (uid, line))
+        else:
+            self.conn.execute(
+                "INSERT INTO completions (uid, text, done_at) VALUES (?, ?, ?)",
+                (uid, line, int(time.time())),
+            )
+
+
+# ================= STORE =================
+class UserStore:
+    """
+    Per-user activity lists kept in memory.
+
+    Users are loaded lazily from `backend` on first access and evicted
+    least-recently-used once more than `capacity` are cached, except those
+    `busy(uid)` says a handler is still working on. Mutations only touch
+    the lists; a background task hands the changes to the backend every
+    `flush_delay` seconds. Every backend call runs on a single worker
+    thread, so the event loop never waits on the disk.
+    """
+
+    def __init__(self, backend, capacity=1024, flush_delay=1.0, busy=None):
+        self.backend = backend
+        self.capacity = capacity
+        self.flush_delay = flush_delay
+        self.busy = busy or (lambda uid: False)
+        self._users = OrderedDict()
+        # evicted users whose changes are still being saved
+        self._evicting = {}
+        self._saves = set()
+        self._loading = {}
+        self._pool = None
+        self._pool_rows = 0
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store")
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def __len__(self):
+        """Users currently cached."""
+        return len(self._users)
+
+    # ---------- root pool ----------
+    async def pool(self) -> IdeaPool:
+        if self._pool is None:
+            rows = await self._run(self.backend.load_root)
+            if self._pool is None:
+                pool = IdeaPool()
+                for text, norm, sig in rows:
+                    pool.add(text, norm, sig)
+                self._pool = pool
+                self._pool_rows = len(rows)
+        return self._pool
+
+    async def refresh(self) -> IdeaPool:
+        """
+        The pool with whatever other processes sharing the backend added
+        since it was read. Ideas are only ever appended, so that is the
+        rows past the ones already seen.
+        """
+        pool = await self.pool()
+        seen = self._pool_rows
+        rows = await self._run(self.backend.load_root, seen)
+        if pool is self._pool and self._pool_rows < seen + len(rows):
+            # a concurrent refresh may have taken some of them already
+            for text, norm, sig in rows[self._pool_rows - seen:]:
+                pool.add(text, norm, sig)
+            self._pool_rows = seen + len(rows)
+        return pool
+
+    async def root(self):
+        """The idea pool, duplicates collapsed."""
+        return (await self.pool()).ideas
+
+    async def add_root(self, task):
+        """
+        Add an idea to the pool unless it (or a near copy) is there already.
+        Returns (the pool's text for it, whether it was added).
+        """
+        pool = await self.refresh()
+        norm, sig = fingerprint(task)
+        task, added = pool.add(task, norm, sig)
+        if added:
+            await self._run(self.backend.add_root, task, norm, sig)
+        return task, added
+
+    # ---------- users ----------
+    async def get(self, uid) -> UserData:
+        user = self._users.get(uid)
+        if user is not None:
+            self._users.move_to_end(uid)
+        elif uid in self._evicting:
+            # back before its save finished: the stored copy may be behind
+            user = self._users[uid] = self._evicting[uid]
+            self._evict()
+        else:
+            user = await self._load(uid)
+
+        if not user.rt:
+            root = (await self.refresh()).ideas
+            if root and not user.rt:
+                user.reseed(root)
+        return user
+
+    async def _load(self, uid):
+        # Concurrent misses for one user share a single load.
+        pending = self._loading.get(uid)
+        if pending is None:
+            pending = self._loading[uid] = asyncio.ensure_future(self._run(self.backend.load, uid))
+            try:
+                user = await pending
+            finally:
+                del self._loading[uid]
+            self._users[uid] = user
+            self._evict()
+            return user
+        await pending
+        return self._users.get(uid) or await self.get(uid)
+
+    def _evict(self):
+        excess = len(self._users) - self.capacity
+        if excess <= 0:
+            return
+        newest = next(reversed(self._users))
+        victims = []
+        for uid in self._users:
+            if len(victims) == excess or uid == newest:
+                break
+            # a handler holding the user across an await would lose its changes
+            if not self.busy(uid):
+                victims.append(uid)
+        for uid in victims:
+            user = self._users.pop(uid)
+            if user.dirty:
+                self._evicting[uid] = user
+                save = asyncio.ensure_future(self._save_evicted(uid, user, user.take_changes()))
+                self._saves.add(save)
+                save.add_done_callback(self._saves.discard)
+
+    async def _save_evicted(self, uid, user, changes):
+        try:
+            await self._run(self.backend.save, [changes])
+        except (OSError, sqlite3.Error):
+            logging.exception("Failed to save evicted user %s", uid)
+            # keep it cached so the flush loop retries
+            user.restore_changes(changes)
+            self._users.setdefault(uid, user)
+        if self._evicting.get(uid) is user:
+            del self._evicting[uid]
+
+    async def reset(self):
+        """Drop every user, cached and stored."""
+        self._users.clear()
+        self._evicting.clear()
+        self._pool = None
+        await self._run(self.backend.reset)
+
+    # ---------- background flush ----------
+    async def flush(self):
+        dirty = [user for user in self._users.values() if user.dirty]
+        if not dirty:
+            return
+        changes = [user.take_changes() for user in dirty]
+        try:
+            await self._run(self.backend.save, changes)
+        except (OSError, sqlite3.Error):
+            logging.exception("Failed to flush %s users", len(dirty))
+            for user, change in zip(dirty, changes):
+                user.restore_changes(change)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_delay)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # a failed eviction save puts its user back for this flush
+        await asyncio.gather(*self._saves)
+        await self.flush()
+        self._executor.shutdown(wait=True)
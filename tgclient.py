@@ -0,0 +1,170 @@
+"""
+Outbound Bot API client: aiogram's Bot with a tuned connection pool,
+pacing sized to Telegram's limits, and retries.
+
+Messages to one chat go out in call order, at most `chat_rate` per second
+after a burst of `chat_burst`, and all chats together at most
+`global_rate` per second; a chat's next message waits until the one
+before it is through. A RetryAfter holds the chat's queue for the time
+Telegram asks and then retries; network errors and Telegram
+restarts are retried with jittered exponential backoff. An edit that
+changes nothing (MessageNotModified) counts as done.
+"""
+import asyncio
+import logging
+import random
+from collections import Counter, OrderedDict
+
+import aiohttp
+from aiogram import Bot
+from aiogram.utils.exceptions import MessageNotModified, NetworkError, RestartingTelegram, RetryAfter
+
+# methods that put something into a chat; the rest (answerCallbackQuery,
+# getMe, setWebhook, ...) are not paced
+PACED = ("send", "edit", "copy", "forward")
+
+
+class TokenBucket:
+    """
+    Reservation bucket: taking a token always succeeds and says how long
+    to wait for it, so callers that take in order are served in order.
+    A rate of 0 means unlimited.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now=0.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, now):
+        """Reserve a token; seconds until it may be used."""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def hold(self, now, seconds):
+        """Nothing more for `seconds` (on top of what is queued)."""
+        if self.rate:
+            self._refill(now)
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def settle(self, sent, now):
+        """
+        Refill from `now` on, not from `sent`: Telegram counts from when
+        the message arrived, so time in flight can't be spent twice.
+        """
+        if self.rate:
+            self._refill(sent)
+            self.stamp = max(self.stamp, now)
+
+    @property
+    def idle(self):
+        return self.tokens >= self.burst
+
+
+class PacedBot(Bot):
+    def __init__(self, *args, chat_rate=1.0, chat_burst=3, global_rate=30.0,
+                 retries=5, backoff=0.5, max_backoff=30.0, chats=10000, **kwargs):
+        kwargs.setdefault("connections_limit", 100)
+        kwargs.setdefault("timeout", aiohttp.ClientTimeout(total=35, sock_connect=10))
+        super().__init__(*args, **kwargs)
+        # one host, many small requests: keep connections and DNS around
+        self._connector_init.update(
+            limit_per_host=self._connector_init["limit"],
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+        )
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats = Counter()
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = OrderedDict()
+        self._max_chats = chats
+
+    def _chat(self, chat_id):
+        """The chat's (bucket, lock); the lock keeps its messages in order."""
+        now = asyncio.get_running_loop().time()
+        entry = self._chats.get(chat_id)
+        if entry is not None:
+            self._chats.move_to_end(chat_id)
+            return entry
+        entry = self._chats[chat_id] = (TokenBucket(self.chat_rate, self.chat_burst, now), asyncio.Lock())
+        # forget the least recently used chats that are caught up
+        while len(self._chats) > self._max_chats:
+            old_id, (bucket, lock) = next(iter(self._chats.items()))
+            bucket._refill(now)
+            if lock.locked() or not bucket.idle:
+                break
+            del self._chats[old_id]
+        return entry
+
+    async def _pace(self, bucket):
+        """Wait for the chat's turn, then for a global one; returns the send time."""
+        loop = asyncio.get_running_loop()
+        # the global token is taken only once the chat may send, so chats
+        # that are waiting don't hold back everyone else
+        for limit in (bucket, self._global):
+            if limit is None:
+                continue
+            delay = limit.take(loop.time())
+            if delay > 0:
+                self.stats["paced"] += 1
+                await asyncio.sleep(delay)
+        return loop.time()
+
+    def _jitter(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        if not method.startswith(PACED):
+            return await self._request(method, data, files, False, None, **kwargs)
+        chat_id = (data or {}).get("chat_id")
+        if chat_id is None:
+            # inline message edits: only the global limit applies
+            return await self._request(method, data, files, True, None, **kwargs)
+        bucket, lock = self._chat(chat_id)
+        async with lock:
+            return await self._request(method, data, files, True, bucket, **kwargs)
+
+    async def _request(self, method, data, files, paced, bucket, **kwargs):
+        # an uploaded file stream can't be replayed
+        retries = 0 if files else self.retries
+        for attempt in range(retries + 1):
+            if paced:
+                sent = await self._pace(bucket)
+            try:
+                result = await super().request(method, data, files, **kwargs)
+                if bucket is not None:
+                    bucket.settle(sent, asyncio.get_running_loop().time())
+                return result
+            except MessageNotModified:
+                self.stats["not_modified"] += 1
+                return True
+            except RetryAfter as e:
+                if attempt == retries:
+                    raise
+                self.stats["retry_after"] += 1
+                if bucket is not None and bucket.rate:
+                    # the chat's next token comes after the wait; _pace sleeps it off
+                    now = asyncio.get_running_loop().time()
+                    bucket.hold(now, e.timeout)
+                else:
+                    await asyncio.sleep(e.timeout)
+            except (NetworkError, RestartingTelegram) as e:
+                if attempt == retries:
+                    raise
+                self.stats["network"] += 1
+                logging.warning("%s failed (%s), retry %s", method, e, attempt + 1)
+                await asyncio.sleep(self._jitter(attempt))